@@ -15,14 +15,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .varlen import varlenDecode, varlenEncode
-import asynchat
 from binascii import b2a_hex
 from collections import deque
 import logging
 import networkserver
 import re
 import socket
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from time import time
 from util import dblsha, tryErr
 
@@ -59,39 +58,46 @@ class BitcoinLink(networkserver.SocketHandler):
 	
 	def handle_readbuf(self):
 		netid = self.server.netid
-		while self.ac_in_buffer:
-			if self.ac_in_buffer[:4] != netid:
-				p = self.ac_in_buffer.find(netid)
-				if p == -1:
-					p = asynchat.find_prefix_at_end(self.ac_in_buffer, netid)
-					if p:
-						self.ac_in_buffer = self.ac_in_buffer[-p:]
-					else:
-						self.ac_in_buffer = b''
+		buf = self.ac_in_buffer
+		lb = len(buf)
+		pos = 0
+		try:
+			while pos < lb:
+				if buf[pos:pos + 4] != netid:
+					p = buf.find(netid, pos)
+					if p == -1:
+						pos = lb - networkserver.find_prefix_at_end(buf[max(pos, lb - 3):], netid)
+						break
+					pos = p
+				
+				if lb - pos < 0x18:
+					# Don't have the whole header yet
 					break
-				self.ac_in_buffer = self.ac_in_buffer[p:]
-			
-			cmd = self.ac_in_buffer[4:0x10].rstrip(b'\0').decode('utf8')
-			payloadLen = unpack('<L', self.ac_in_buffer[0x10:0x14])[0]
-			if payloadLen > MAX_PACKET_PAYLOAD:
-				raise RuntimeError('Packet payload is too long (%d bytes)' % (payloadLen,))
-			payloadEnd = payloadLen + 0x18
-			if len(self.ac_in_buffer) < payloadEnd:
-				# Don't have the whole packet yet
-				break
-			
-			method = 'doCmd_' + cmd
-			cksum = self.ac_in_buffer[0x14:0x18]
-			payload = self.ac_in_buffer[0x18:payloadEnd]
-			self.ac_in_buffer = self.ac_in_buffer[payloadEnd:]
-			
-			realcksum = dblsha(payload)[:4]
-			if realcksum != cksum:
-				self.logger.debug('Wrong checksum on `%s\' message (%s vs actual:%s); ignoring' % (cmd, b2a_hex(cksum), b2a_hex(realcksum)))
-				return
-			
-			if hasattr(self, method):
-				getattr(self, method)(payload)
+				cmd = buf[pos + 4:pos + 0x10].rstrip(b'\0').decode('utf8')
+				payloadLen = unpack_from('<L', buf, pos + 0x10)[0]
+				if payloadLen > MAX_PACKET_PAYLOAD:
+					raise RuntimeError('Packet payload is too long (%d bytes)' % (payloadLen,))
+				payloadEnd = pos + payloadLen + 0x18
+				if lb < payloadEnd:
+					# Don't have the whole packet yet
+					break
+				
+				method = 'doCmd_' + cmd
+				cksum = bytes(buf[pos + 0x14:pos + 0x18])
+				payload = bytes(buf[pos + 0x18:payloadEnd])
+				pos = payloadEnd
+				
+				realcksum = dblsha(payload)[:4]
+				if realcksum != cksum:
+					self.logger.debug('Wrong checksum on `%s\' message (%s vs actual:%s); ignoring' % (cmd, b2a_hex(cksum), b2a_hex(realcksum)))
+					return
+				
+				if hasattr(self, method):
+					getattr(self, method)(payload)
+				if self.ac_in_buffer is not buf:
+					break
+		finally:
+			self._trimInput(buf, pos)
 	
 	def pushMessage(self, *a, **ka):
 		self.push(self.server.makeMessage(*a, **ka))
@@ -40,6 +40,9 @@ if not hasattr(config, 'WorkUpdateInterval'):
 config.StaleWorkTimeout = max(120, config.WorkUpdateInterval * 2)
 util.UniqueSessionIdManager._defaultDelay = config.StaleWorkTimeout
 
+if not hasattr(config, 'WorkLogPruneInterval'):
+	config.WorkLogPruneInterval = 5
+
 
 import logging
 import logging.handlers
@@ -81,6 +84,10 @@ def RaiseRedFlags(reason):
 	return reason
 
 
+import networkserver
+if hasattr(config, 'EventLoop'):
+	networkserver.AsyncSocketServer.EventLoop = config.EventLoop
+
 from bitcoin.node import BitcoinLink, BitcoinNode
 bcnode = BitcoinNode(config.UpstreamNetworkId)
 bcnode.userAgent += b'Eloipool:0.1/'
@@ -144,12 +151,13 @@ def makeCoinbaseTxn(coinbaseValue, useCoinbaser = True, prevBlockHex = None, wit
 
 
 import jsonrpc_getwork
+from userstatus import UserStatus
 from util import Bits2Target
 
 workLog = {}
-userStatus = {}
+userStatus = UserStatus()
 networkTarget = None
-DupeShareHACK = {}
+DupeShares = util.DupeShareIndex()
 
 server = None
 stratumsrv = None
@@ -165,36 +173,85 @@ def blockChanged():
 	else:
 		networkTarget = Bits2Target(bits)
 	if MM.lastBlock != (None, None, None):
-		global DupeShareHACK
-		DupeShareHACK = {}
+		with DupeShares.lock:
+			DupeShares.clear()
+			workLog.clear()
 		jsonrpc_getwork._CheckForDupesHACK = {}
-		workLog.clear()
+		workLogExpiry.clear()
 	server.wakeLongpoll(wantClear=True)
 	stratumsrv.updateJob(wantClear=True)
 
 
+from collections import deque
 from time import sleep, time
 import traceback
 
+# (bucket, [(username, wli), ...]) in order of issue time, so the pruner only
+# has to look at work that has actually expired
+workLogExpiry = deque()
+
+def trackWork(username, wli, issueT):
+	bucket = int(issueT // config.WorkLogPruneInterval)
+	try:
+		last = workLogExpiry[-1]
+	except IndexError:
+		pass
+	else:
+		# NOTE: Work issued out of order just goes in the latest bucket, to be pruned a little late
+		if last[0] >= bucket:
+			last[1].append((username, wli))
+			return
+	workLogExpiry.append((bucket, [(username, wli)]))
+
 def _WorkLogPruner_I(wl):
 	now = time()
+	expireT = now - config.StaleWorkTimeout
+	expireBucket = int(expireT // config.WorkLogPruneInterval)
 	pruned = 0
-	for username in wl:
-		userwork = wl[username]
-		for wli in tuple(userwork.keys()):
-			if now > userwork[wli][1] + config.StaleWorkTimeout:
-				del userwork[wli]
-				pruned += 1
-	WorkLogPruner.logger.debug('Pruned %d jobs' % (pruned,))
+	while workLogExpiry and workLogExpiry[0][0] < expireBucket:
+		(bucket, keys) = workLogExpiry.popleft()
+		for (username, wli) in keys:
+			userwork = wl.get(username)
+			if not userwork:
+				continue
+			issueT = userwork.get(wli, (None, None))[1]
+			if issueT is None:
+				continue
+			if issueT > expireT:
+				# Reissued since
+				trackWork(username, wli, issueT)
+				continue
+			with DupeShares.lock:
+				userwork.pop(wli, None)
+				DupeShares.prune((username, wli))
+			pruned += 1
+	
+	dt = time() - now
+	stats = WorkLogPruner.stats
+	stats['runs'] += 1
+	stats['pruned'] += pruned
+	stats['lastPruned'] = pruned
+	stats['lastDuration'] = dt
+	stats['maxDuration'] = max(stats['maxDuration'], dt)
+	stats['totalDuration'] += dt
+	WorkLogPruner.logger.debug('Pruned %d jobs in %.3f seconds' % (pruned, dt))
 
 def WorkLogPruner(wl):
 	while True:
 		try:
-			sleep(60)
+			sleep(config.WorkLogPruneInterval)
 			_WorkLogPruner_I(wl)
 		except:
 			WorkLogPruner.logger.error(traceback.format_exc())
 WorkLogPruner.logger = logging.getLogger('WorkLogPruner')
+WorkLogPruner.stats = {
+	'runs': 0,
+	'pruned': 0,
+	'lastPruned': 0,
+	'lastDuration': 0.,
+	'maxDuration': 0.,
+	'totalDuration': 0.,
+}
 
 
 from merklemaker import merkleMaker
@@ -211,11 +268,15 @@ from math import ceil, log
 from merklemaker import MakeBlockHeader
 from struct import pack, unpack
 import threading
-from time import time
-from util import PendingUpstream, RejectedShare, bdiff1target, dblsha, LEhash2int, swap32, target2bdiff, target2pdiff
+from time import perf_counter, time
+from sharevalidator import checkCoinbase, checkHash, checkHeader, checkStratumShare, StratumJob
+import stratumserver
+from util import PendingUpstream, PendingValidation, RejectedShare, bdiff1target, dblsha, LEhash2int, swap32, target2bdiff, target2pdiff
 import jsonrpc
 import traceback
 
+StratumExtranonceSize = util.UniqueSessionIdManager.size() + stratumserver.extranonce2sz
+
 gotwork = None
 if hasattr(config, 'GotWorkURI'):
 	gotwork = jsonrpc.ServiceProxy(config.GotWorkURI)
@@ -232,6 +293,8 @@ else:
 	config.DynamicTargetGoal *= config.DynamicTargetWindow / 60
 	if not hasattr(config, 'DynamicTargetQuick'):
 		config.DynamicTargetQuick = True
+	if not hasattr(config, 'DynamicTargetSweepInterval'):
+		config.DynamicTargetSweepInterval = config.DynamicTargetWindow / 12
 
 def submitGotwork(info):
 	try:
@@ -271,24 +334,16 @@ def getTarget(username, now, DTMode = None, RequestedTarget = None):
 		DTMode = config.DynamicTargetting
 	if not DTMode:
 		return None
-	if username in userStatus:
-		status = userStatus[username]
-	else:
+	uid = userStatus.uid(username)
+	if uid is None:
 		# No record, use default target
 		RequestedTarget = clampTarget(RequestedTarget, DTMode)
-		userStatus[username] = [RequestedTarget, now, 0]
+		userStatus.add(username, RequestedTarget, now)
 		return RequestedTarget
-	(targetIn, lastUpdate, work) = status
+	(targetIn, lastUpdate, work) = userStatus.get(uid)
 	if work <= config.DynamicTargetGoal:
-		if now < lastUpdate + config.DynamicTargetWindow and (targetIn is None or targetIn >= networkTarget):
-			# No reason to change it just yet
-			return clampTarget(targetIn, DTMode)
-		if not work:
-			# No shares received, reset to minimum
-			if targetIn:
-				getTarget.logger.debug("No shares from %s, resetting to minimum target" % (repr(username),))
-				userStatus[username] = [None, now, 0]
-			return clampTarget(None, DTMode)
+		# Anything else is left for DynamicTargetSweeper
+		return clampTarget(targetIn, DTMode)
 	
 	deltaSec = now - lastUpdate
 	target = targetIn or config.ShareTarget
@@ -300,20 +355,48 @@ def getTarget(username, now, DTMode = None, RequestedTarget = None):
 		getTarget.logger.debug("%s from: %064x (pdiff %s)" % (pfx, tin, target2pdiff(tin)))
 		tgt = target or config.ShareTarget
 		getTarget.logger.debug("%s   to: %064x (pdiff %s)" % (pfx, tgt, target2pdiff(tgt)))
-	userStatus[username] = [target, now, 0]
+	userStatus.set(uid, target, now)
 	return target
 getTarget.logger = logging.getLogger('getTarget')
 
+# Starts username over at RequestedTarget (eg, a new stratum connection)
+def resetTarget(username, now, RequestedTarget = None):
+	DTMode = config.DynamicTargetting
+	if not DTMode:
+		return None
+	target = clampTarget(RequestedTarget, DTMode)
+	uid = userStatus.uid(username)
+	if uid is None:
+		userStatus.add(username, target, now)
+	else:
+		userStatus.set(uid, target, now)
+	return target
+
+# Retargets every user at once, rather than as each one asks for work
+def _DynamicTargetSweeper_I():
+	now = time()
+	DTMode = config.DynamicTargetting
+	clamp = lambda target: clampTarget(target, DTMode)
+	(changed, reset) = userStatus.sweep(now, config.DynamicTargetGoal, config.DynamicTargetWindow, config.ShareTarget, networkTarget, clamp)
+	DynamicTargetSweeper.logger.debug('Retargetted %d of %d users (%d reset to minimum) in %.3f seconds' % (changed, len(userStatus), reset, time() - now))
+
+def DynamicTargetSweeper():
+	while True:
+		try:
+			sleep(config.DynamicTargetSweepInterval)
+			_DynamicTargetSweeper_I()
+		except:
+			DynamicTargetSweeper.logger.error(traceback.format_exc())
+DynamicTargetSweeper.logger = logging.getLogger('DynamicTargetSweeper')
+
 def TopTargets(n = 0x10):
-	tmp = list(k for k, v in userStatus.items() if not v[0] is None)
-	tmp.sort(key=lambda k: -userStatus[k][0])
 	tmp2 = {}
 	def t2d(t):
 		if t not in tmp2:
 			tmp2[t] = target2pdiff(t)
 		return tmp2[t]
-	for k in tmp[-n:]:
-		tgt = userStatus[k][0]
+	# By worker, not by stratum connection
+	for k, tgt in userStatus.top(n, exclude=stratumserver.TargetKeyPrefix):
 		print('%-34s %064x %3d' % (k, tgt, t2d(tgt)))
 
 def RegisterWork(username, wli, wld, RequestedTarget = None):
@@ -321,6 +404,7 @@ def RegisterWork(username, wli, wld, RequestedTarget = None):
 	target = getTarget(username, now, RequestedTarget=RequestedTarget)
 	wld = tuple(wld) + (target,)
 	workLog.setdefault(username, {})[wli] = (wld, now)
+	trackWork(username, wli, now)
 	return target or config.ShareTarget
 
 def getBlockHeader(username):
@@ -350,10 +434,19 @@ def getBlockTemplate(username, p_magic = None, RequestedTarget = None):
 def getStratumJob(jobid, wantClear = False):
 	MC = MM.getMC(wantClear)
 	(dummy, merkleTree, coinbase, prevBlock, bits) = MC[:5]
+	# NOTE: Stratum targets are tracked per-connection, so there is never one in the job itself
+	MC += (None, StratumJob(merkleTree, coinbase, StratumExtranonceSize))
 	now = time()
 	workLog.setdefault(None, {})[jobid] = (MC, now)
+	trackWork(None, jobid, now)
 	return (MC, workLog[None][jobid])
 
+def _getStratumJob(wld):
+	if len(wld) > 7:
+		return wld[7]
+	# Restored from an older saved state
+	return StratumJob(wld[1], wld[2], StratumExtranonceSize)
+
 def getExistingStratumJob(jobid):
 	wld = workLog[None][jobid]
 	return (wld[0], wld)
@@ -496,8 +589,8 @@ def LookupWork(username, wli):
 		raise RejectedShare('unknown-work')
 	return MWL[wli]
 
-def checkShare(share):
-	shareTime = share['time'] = time()
+def _checkShareLookup(share):
+	share['time'] = time()
 	
 	username = share['username']
 	checkQuickDiffAdjustment = False
@@ -505,7 +598,7 @@ def checkShare(share):
 		# getwork/GBT
 		data = share['data']
 		
-		shareMerkleRoot = data[36:68]
+		wluser = username
 		if 'blkdata' in share:
 			pl = share['blkdata']
 			(txncount, pl) = varlenDecode(pl)
@@ -518,43 +611,133 @@ def checkShare(share):
 			mode = 'MC'
 			moden = 1
 		else:
-			wli = shareMerkleRoot
+			wli = data[36:68]
 			mode = 'MRD'
 			moden = 0
 			coinbase = None
-		
-		(wld, issueT) = LookupWork(username, wli)
-		checkData(share, wld)
+			othertxndata = b''
 	else:
 		# Stratum
 		checkQuickDiffAdjustment = config.DynamicTargetQuick
+		wluser = None
 		wli = share['jobid']
-		(wld, issueT) = LookupWork(None, wli)
 		mode = 'MC'
 		moden = 1
+		coinbase = None
 		othertxndata = b''
 	
+	if ShareCapture:
+		ShareCapture.capture(share, wluser, wli, workLog.get(wluser, {}).get(wli), MM.currentBlock, MM.lastBlock, networkTarget)
+	
+	(wld, issueT) = LookupWork(wluser, wli)
+	if 'data' in share:
+		checkData(share, wld)
+	
 	share[mode] = wld
 	
 	share['issuetime'] = issueT
 	
-	(workMerkleTree, workCoinbase) = wld[1:3]
-	share['merkletree'] = workMerkleTree
+	share['merkletree'] = wld[1]
+	
+	if 'target' in share:
+		workTarget = share['target']
+	elif len(wld) > 6:
+		workTarget = wld[6]
+	else:
+		workTarget = None
+	
+	if workTarget is None:
+		workTarget = config.ShareTarget
+	
+	_markStage(share, 'lookup')
+	return (wli, wld, issueT, moden, coinbase, othertxndata, workTarget, checkQuickDiffAdjustment)
+
+# BIP310 version rolling: the miner may only change bits in the negotiated mask
+# Some miners send just the rolled bits, others the whole version
+def stratumVersionBytes(share, wld):
+	version = wld[1].MP['version']
+	versionbits = share['versionbits']
+	mask = share.get('versionmask') or 0
+	outside = versionbits & ~mask
+	if outside and outside != version & ~mask:
+		raise RejectedShare('bad-version')
+	return pack('<L', (version & ~mask) | (versionbits & mask))
+
+def _checkShareArgs(share, ctx):
+	(wli, wld, issueT, moden, coinbase, othertxndata, workTarget, checkQuickDiffAdjustment) = ctx
+	if 'jobid' in share:
+		(prevBlock, height, bits) = MM.currentBlock
+		versionBytes = stratumVersionBytes(share, wld) if 'versionbits' in share else None
+		args = (share['extranonce1'] + share['extranonce2'], share['ntime'], share['nonce'], prevBlock, bits, workTarget, versionBytes)
+		return (wli, lambda: _getStratumJob(wld), checkStratumShare, args)
+	if 'blkdata' in share:
+		# GBT submissions are always checked inline
+		return None
+	return (None, None, checkHeader, (share['data'], workTarget))
+
+def _checkShareHash(share, ctx):
+	(wli, wld, issueT, moden, coinbase, othertxndata, workTarget, checkQuickDiffAdjustment) = ctx
+	a = _checkShareArgs(share, ctx)
+	if a is None:
+		(blkhash, hashReject) = checkHash(share['data'], workTarget)
+		rv = (share['data'], blkhash, hashReject, checkCoinbase(coinbase, len(wld[2])))
+	else:
+		(jobkey, jobf, func, args) = a
+		stages = share.get('_stages')
+		if stages and func is checkStratumShare:
+			rv = func(jobf() if jobkey else None, *args, stages=stages)
+		else:
+			rv = func(jobf() if jobkey else None, *args)
+	_markStage(share, 'hash')
+	return rv
+
+def _makeTxnList(share, wld, coinbase):
+	workMerkleTree = wld[1]
 	if 'jobid' in share:
+		cbtxn = bitcoin.txn.Txn(_getStratumJob(wld).coinbaseTxnData(share['extranonce1'] + share['extranonce2']))
+	else:
 		cbtxn = deepcopy(workMerkleTree.data[0])
-		coinbase = workCoinbase + share['extranonce1'] + share['extranonce2']
-		cbtxn.setCoinbase(coinbase)
+		cbtxn.setCoinbase(coinbase or wld[2])
 		cbtxn.assemble()
-		data = buildStratumData(share, workMerkleTree.withFirst(cbtxn), workMerkleTree.MP['_BlockVersionBytes'])
-		shareMerkleRoot = data[36:68]
+	return [cbtxn,] + workMerkleTree.data[1:]
+
+# Returns the work done since the last retarget, in units of the current target
+# NOTE: userStatus only doesn't have the username across restarts, unless
+#       create is set (for workers, which are always counted)
+def _addTargetWork(username, workTarget, create = False):
+	uid = userStatus.uid(username)
+	if uid is None:
+		if not create:
+			return None
+		uid = userStatus.add(username, None, time())
+	target = userStatus.targets[uid] or config.ShareTarget
+	if target == workTarget:
+		return userStatus.addWork(uid, 1)
+	return userStatus.addWork(uid, float(target) / workTarget)
+
+def _checkShareFinish(share, ctx, rv):
+	(wli, wld, issueT, moden, coinbase, othertxndata, workTarget, checkQuickDiffAdjustment) = ctx
+	(data, blkhash, hashReject, cbReject) = rv
+	shareTime = share['time']
+	username = share['username']
+	
+	(workMerkleTree, workCoinbase) = wld[1:3]
+	if 'jobid' in share:
+		coinbase = workCoinbase + share['extranonce1'] + share['extranonce2']
+		share['data'] = data
+	shareMerkleRoot = data[36:68]
 	
-	if data in DupeShareHACK:
-		raise RejectedShare('duplicate')
-	DupeShareHACK[data] = None
+	wluser = None if 'jobid' in share else username
+	with DupeShares.lock:
+		# Work pruned since it was looked up can't be checked for duplicates
+		if not wli in workLog.get(wluser, ()):
+			raise RejectedShare('stale-work')
+		if DupeShares.add((wluser, wli), blkhash):
+			raise RejectedShare('duplicate')
+	_markStage(share, 'dupe')
 	
-	blkhash = dblsha(data)
-	if blkhash[28:] != b'\0\0\0\0':
-		raise RejectedShare('H-not-zero')
+	if hashReject == 'H-not-zero':
+		raise RejectedShare(hashReject)
 	blkhashn = LEhash2int(blkhash)
 	
 	global networkTarget
@@ -562,12 +745,10 @@ def checkShare(share):
 	logfunc('BLKHASH: %64x' % (blkhashn,))
 	logfunc(' TARGET: %64x' % (networkTarget,))
 	
-	# NOTE: this isn't actually needed for MC mode, but we're abusing it for a trivial share check...
-	txlist = workMerkleTree.data
-	txlist = [deepcopy(txlist[0]),] + txlist[1:]
-	cbtxn = txlist[0]
-	cbtxn.setCoinbase(coinbase or workCoinbase)
-	cbtxn.assemble()
+	# The transaction list is only needed for blocks, gotwork, and checking GBT submissions
+	if 'blkdata' in share or blkhashn <= networkTarget or (gotwork and blkhashn <= config.GotWorkTarget):
+		txlist = _makeTxnList(share, wld, coinbase)
+		cbtxn = txlist[0]
 	
 	if blkhashn <= networkTarget:
 		logfunc("Submitting upstream")
@@ -611,17 +792,8 @@ def checkShare(share):
 		except:
 			checkShare.logger.warning('Failed to build gotwork request')
 	
-	if 'target' in share:
-		workTarget = share['target']
-	elif len(wld) > 6:
-		workTarget = wld[6]
-	else:
-		workTarget = None
-	
-	if workTarget is None:
-		workTarget = config.ShareTarget
-	if blkhashn > workTarget:
-		raise RejectedShare('high-hash')
+	if hashReject:
+		raise RejectedShare(hashReject)
 	share['target'] = workTarget
 	share['_targethex'] = '%064x' % (workTarget,)
 	
@@ -639,15 +811,11 @@ def checkShare(share):
 		if coinbase[:cbpreLen] != cbpre:
 			raise RejectedShare('bad-cb-prefix')
 		
-		# Filter out known "I support" flags, to prevent exploits
-		for ff in (b'/P2SH/', b'NOP2SH', b'p2sh/CHV', b'p2sh/NOCHV'):
-			if coinbase.find(ff) > max(-1, cbpreLen - len(ff)):
-				raise RejectedShare('bad-cb-flag')
+		if cbReject:
+			raise RejectedShare(cbReject)
 		
-		if len(coinbase) > 100:
-			raise RejectedShare('bad-cb-length')
-		
-		if shareMerkleRoot != workMerkleTree.withFirst(cbtxn):
+		# Stratum merkle roots are derived from the coinbase itself, so only check GBT
+		if 'jobid' not in share and shareMerkleRoot != workMerkleTree.withFirst(cbtxn):
 			raise RejectedShare('bad-txnmrklroot')
 		
 		if len(othertxndata):
@@ -655,16 +823,36 @@ def checkShare(share):
 			if allowed != share['blkdata']:
 				raise RejectedShare('bad-txns')
 	
-	if config.DynamicTargetting and username in userStatus:
-		# NOTE: userStatus[username] only doesn't exist across restarts
-		status = userStatus[username]
-		target = status[0] or config.ShareTarget
-		if target == workTarget:
-			userStatus[username][2] += 1
-		else:
-			userStatus[username][2] += float(target) / workTarget
-		if checkQuickDiffAdjustment and userStatus[username][2] > config.DynamicTargetGoal * 2:
-			stratumsrv.quickDifficultyUpdate(username)
+	# Stratum connections are retargetted as a whole, and their workers' work
+	# is counted too, for per-worker reporting (and any getwork targets)
+	targetKey = share.get('targetKey', username)
+	if config.DynamicTargetting:
+		work = _addTargetWork(targetKey, workTarget)
+		if checkQuickDiffAdjustment and not work is None and work > config.DynamicTargetGoal * 2:
+			stratumsrv.quickDifficultyUpdate(targetKey)
+		if targetKey != username:
+			_addTargetWork(username, workTarget, create=True)
+	
+	_markStage(share, 'finish')
+
+# Per-stage timings of a sample of shares, and counts of all of them
+# eg, print(ShareTimings.report()) from interactivemode, or ShareTimings.export()
+# (stratumsrv.logStats() similarly logs job broadcast latency and WriteStats)
+ShareTimings = util.StageTimings(getattr(config, 'ShareTimingSampleInterval', 0x40))
+
+def _sampleShare(share):
+	stages = ShareTimings.sample()
+	if stages:
+		share['_stages'] = stages
+
+def _markStage(share, stage):
+	stages = share.get('_stages')
+	if stages:
+		stages.append((stage, perf_counter()))
+
+def checkShare(share):
+	ctx = _checkShareLookup(share)
+	_checkShareFinish(share, ctx, _checkShareHash(share, ctx))
 checkShare.logger = logging.getLogger('checkShare')
 
 def logShare(share):
@@ -685,22 +873,119 @@ def checkAuthentication(username, password):
 			return True
 	return False
 
-def receiveShare(share):
+ShareValidator = None
+ShareCapture = None
+
+def _shareRejected(share, e):
+	share['rejectReason'] = str(e) if isinstance(e, RejectedShare) else 'ERROR'
+
+def _shareChecked(share):
+	if 'data' not in share:
+		# In case of rejection, data might not have been defined yet, but logging may need it
+		buildStratumData(share, b'\0' * 32, b'\xff\xff\xff\xff')
+	if not share.get('upstreamRejectReason', None) is PendingUpstream:
+		logShare(share)
+	stages = share.pop('_stages', None)
+	if stages:
+		stages.append(('log', perf_counter()))
+	ShareTimings.count(share.get('submitProtocol'), share.get('rejectReason') or 'accepted', stages)
+
+def _receiveShareFailed(share, e):
+	_shareRejected(share, e)
+	if not isinstance(e, RejectedShare):
+		checkShare.logger.error(traceback.format_exc())
+	_shareChecked(share)
+	return e
+
+# The validator calls back from its own thread, so the rest of the check
+# (which touches handler state, eg by quickDifficultyUpdate) is handed back
+# to the loop of the server the share came in on, when scheduleNow is given
+def _validatedCallback(share, ctx, onValidated, scheduleNow):
+	finish = lambda rv: _receiveShareValidated(share, ctx, onValidated, rv)
+	if scheduleNow is None:
+		return finish
+	return lambda rv: scheduleNow(lambda: finish(rv))
+
+def _receiveShareValidated(share, ctx, onValidated, rv):
+	_markStage(share, 'validator')
+	try:
+		if isinstance(rv, BaseException):
+			raise rv
+		_checkShareFinish(share, ctx, rv)
+	except BaseException as e:
+		onValidated(_receiveShareFailed(share, e))
+		return
+	_shareChecked(share)
+	onValidated(None)
+
+# If onValidated is provided, the share may be checked by ShareValidator, in
+# which case PendingValidation is returned and onValidated is later called
+# with None or the exception rejecting the share; that, and the rest of the
+# check, happens via scheduleNow if given, or else on the validator's thread
+def receiveShare(share, onValidated = None, scheduleNow = None):
 	# TODO: username => userid
+	_sampleShare(share)
 	try:
-		checkShare(share)
-	except RejectedShare as rej:
-		share['rejectReason'] = str(rej)
-		raise
+		if onValidated and ShareValidator:
+			ctx = _checkShareLookup(share)
+			a = _checkShareArgs(share, ctx)
+			if a and ShareValidator.validate(*a, callback=_validatedCallback(share, ctx, onValidated, scheduleNow)):
+				return PendingValidation
+			_checkShareFinish(share, ctx, _checkShareHash(share, ctx))
+		else:
+			checkShare(share)
 	except BaseException as e:
-		share['rejectReason'] = 'ERROR'
+		_shareRejected(share, e)
+		_shareChecked(share)
 		raise
-	finally:
-		if 'data' not in share:
-			# In case of rejection, data might not have been defined yet, but logging may need it
-			buildStratumData(share, b'\0' * 32, b'\xff\xff\xff\xff')
-		if not share.get('upstreamRejectReason', None) is PendingUpstream:
-			logShare(share)
+	_shareChecked(share)
+
+def _receiveShareInline(share, ctx):
+	try:
+		if ctx is None:
+			ctx = _checkShareLookup(share)
+		_checkShareFinish(share, ctx, _checkShareHash(share, ctx))
+	except BaseException as e:
+		return _receiveShareFailed(share, e)
+	_shareChecked(share)
+
+# Like receiveShare, for a list of (share, onValidated) received together
+# Returns a list of results: None for accepted shares, the exception for
+# rejected ones, or PendingValidation if onValidated will be called later
+def receiveShares(shares, scheduleNow = None):
+	if not ShareValidator:
+		rvs = []
+		for (share, onValidated) in shares:
+			_sampleShare(share)
+			rvs.append(_receiveShareInline(share, None))
+		return rvs
+	
+	rvs = [None] * len(shares)
+	batch = []
+	for i in range(len(shares)):
+		(share, onValidated) = shares[i]
+		_sampleShare(share)
+		try:
+			ctx = _checkShareLookup(share)
+			a = _checkShareArgs(share, ctx)
+		except BaseException as e:
+			rvs[i] = _receiveShareFailed(share, e)
+			continue
+		if a:
+			batch.append((i, share, ctx, a + (_validatedCallback(share, ctx, onValidated, scheduleNow),)))
+		else:
+			rvs[i] = _receiveShareInline(share, ctx)
+	
+	if batch:
+		try:
+			dispatched = ShareValidator.validateMany(list(b[3] for b in batch))
+		except:
+			checkShare.logger.error(traceback.format_exc())
+			dispatched = False
+		for (i, share, ctx, a) in batch:
+			rvs[i] = PendingValidation if dispatched else _receiveShareInline(share, ctx)
+	
+	return rvs
 
 def newBlockNotification():
 	logging.getLogger('newBlockNotification').info('Received new block notification')
@@ -718,6 +1003,7 @@ from signal import signal, SIGUSR1
 signal(SIGUSR1, newBlockNotificationSIGNAL)
 
 
+from functools import partial
 import os
 import os.path
 import pickle
@@ -769,6 +1055,8 @@ def stopLoggers():
 	for i in loggersShare:
 		if hasattr(i, 'stop'):
 			i.stop()
+	if ShareCapture:
+		ShareCapture.flush()
 
 def saveState(SAVE_STATE_FILENAME, t = None):
 	logger = logging.getLogger('saveState')
@@ -780,7 +1068,7 @@ def saveState(SAVE_STATE_FILENAME, t = None):
 		try:
 			with open(SAVE_STATE_FILENAME, 'wb') as f:
 				pickle.dump(t, f)
-				pickle.dump(DupeShareHACK, f)
+				pickle.dump(DupeShares, f)
 				pickle.dump(workLog, f)
 			break
 		except:
@@ -816,7 +1104,7 @@ def restoreState(SAVE_STATE_FILENAME):
 	if not os.path.exists(SAVE_STATE_FILENAME):
 		return
 	
-	global workLog, DupeShareHACK
+	global workLog, DupeShares
 	
 	logger = logging.getLogger('restoreState')
 	s = os.stat(SAVE_STATE_FILENAME)
@@ -832,35 +1120,127 @@ def restoreState(SAVE_STATE_FILENAME):
 				
 				# Old format, from 2012-02-02 to 2012-02-03
 				workLog = t[0]
-				DupeShareHACK = t[1]
 				t = None
 			else:
 				if isinstance(t, dict):
 					# Old format, from 2012-02-03 to 2012-02-03
-					DupeShareHACK = t
 					t = None
 				else:
 					# Current format, from 2012-02-03 onward
-					DupeShareHACK = pickle.load(f)
+					dupes = pickle.load(f)
+					# NOTE: Older saves have a dict of share data, which can't be partitioned by work
+					if isinstance(dupes, util.DupeShareIndex):
+						DupeShares = dupes
 				
 				if t + config.StaleWorkTimeout >= time():
 					workLog = pickle.load(f)
 				else:
 					logger.debug('Skipping restore of expired workLog')
+					DupeShares.clear()
 	except:
 		logger.error('Failed to restore state\n' + traceback.format_exc())
 		return
+	workLogExpiry.clear()
+	work = []
+	for username, userwork in workLog.items():
+		for wli, (wld, issueT) in userwork.items():
+			work.append((issueT, username, wli))
+	work.sort(key=lambda w: w[0])
+	for (issueT, username, wli) in work:
+		trackWork(username, wli, issueT)
 	logger.info('State restored successfully')
 	if t:
 		logger.info('Total downtime: %g seconds' % (time() - t,))
 
 
+def loadAuthenticators():
+	import authentication
+	import imp
+	
+	if not hasattr(config, 'Authentication'):
+		config.Authentication = ({'module': 'allowall'},)
+	
+	for i in config.Authentication:
+		name = i['module']
+		parameters = i
+		try:
+			fp, pathname, description = imp.find_module(name, authentication.__path__)
+			m = imp.load_module(name, fp, pathname, description)
+			lo = getattr(m, name)(**parameters)
+			authenticators.append(lo)
+		except:
+			logging.getLogger('authentication').error("Error setting up authentication module %s: %s", name, sys.exc_info())
+
+def configureServer(s):
+	if getattr(config, 'CoalesceWrites', False):
+		s.CoalesceWrites = True
+	
+	if getattr(config, 'EdgeTriggered', False):
+		s.EdgeTriggered = True
+		if hasattr(config, 'ReadSize'):
+			s.ReadSize = config.ReadSize
+		if hasattr(config, 'ReadBudget'):
+			s.ReadBudget = config.ReadBudget
+
+# Settings for the StratumServer with the clients (in a frontend, if any)
+def configureStratumServer(s):
+	s.checkAuthentication = checkAuthentication
+	s.RaiseRedFlags = RaiseRedFlags
+	s.defaultTarget = config.ShareTarget
+	s.StaleWorkTimeout = config.StaleWorkTimeout
+	if hasattr(config, 'StratumVersionRollingMask'):
+		s.VersionRollingMask = config.StratumVersionRollingMask
+	if hasattr(config, 'StratumLoadShedding'):
+		LS = config.StratumLoadShedding
+		s.ShedPeers = tuple(LS['peers'])
+		s.ShedMaxLoopLag = LS.get('maxLoopLag')
+		s.ShedMaxPendingShares = LS.get('maxPendingShares')
+		s.ShedMaxConnections = LS.get('maxConnections')
+		for (k, a) in (('fraction', 'ShedFraction'), ('interval', 'ShedInterval'), ('resumeLevel', 'ShedResumeLevel')):
+			if k in LS:
+				setattr(s, a, LS[k])
+	if hasattr(config, 'StratumBroadcastTimeSlice'):
+		s.BroadcastTimeSlice = config.StratumBroadcastTimeSlice
+	if hasattr(config, 'StratumStatsLogInterval'):
+		s.StatsLogInterval = config.StratumStatsLogInterval
+
+# Runs in each stratum frontend process
+def StratumFrontendMain(index, count, sock):
+	from networkserver import NetworkListener
+	from stratumfrontend import StratumFrontend
+	
+	# Block notifications are for the core
+	signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+	# Frontends issue session ids from separate ranges
+	util.UniqueSessionIdManager.partition(index, count)
+	loadAuthenticators()
+	
+	srv = StratumFrontend(sock)
+	configureStratumServer(srv)
+	configureServer(srv)
+	for a in getattr(config, 'StratumAddresses', ()):
+		NetworkListener(srv, a, reuse_port=True)
+	srv.serve_forever()
+
+# NOTE: The stratum frontend and validator processes are forked, so this must happen before any threads are started (including interactivemode's)
+StratumFrontendSockets = ()
+if __name__ == "__main__" and getattr(config, 'StratumFrontends', 0):
+	from stratumfrontend import startFrontends
+	StratumFrontendSockets = startFrontends(config.StratumFrontends, StratumFrontendMain)
+
+if __name__ == "__main__" and getattr(config, 'ShareValidatorProcesses', 0):
+	from sharevalidator import ShareValidatorPool
+	ShareValidator = ShareValidatorPool(config.ShareValidatorProcesses)
+
+
 from jsonrpcserver import JSONRPCListener, JSONRPCServer
-import interactivemode
+if __name__ == "__main__":
+	# NOTE: Not when imported by tools such as sharereplay
+	import interactivemode
 from networkserver import NetworkListener
 import threading
 import sharelogging
-import authentication
+from stratumfrontend import StratumCore
 from stratumserver import StratumServer
 import imp
 
@@ -907,19 +1287,11 @@ if __name__ == "__main__":
 		except:
 			logging.getLogger('sharelogging').error("Error setting up share logger %s: %s", name,  sys.exc_info())
 	
-	if not hasattr(config, 'Authentication'):
-		config.Authentication = ({'module': 'allowall'},)
+	if hasattr(config, 'ShareCapture'):
+		from sharereplay import ShareCapture
+		ShareCapture = ShareCapture(**config.ShareCapture)
 	
-	for i in config.Authentication:
-		name = i['module']
-		parameters = i
-		try:
-			fp, pathname, description = imp.find_module(name, authentication.__path__)
-			m = imp.load_module(name, fp, pathname, description)
-			lo = getattr(m, name)(**parameters)
-			authenticators.append(lo)
-		except:
-			logging.getLogger('authentication').error("Error setting up authentication module %s: %s", name, sys.exc_info())
+	loadAuthenticators()
 	
 	LSbc = []
 	if not hasattr(config, 'BitcoinNodeAddresses'):
@@ -950,7 +1322,7 @@ if __name__ == "__main__":
 	server.aux = MM.CoinbaseAux
 	server.getBlockHeader = getBlockHeader
 	server.getBlockTemplate = getBlockTemplate
-	server.receiveShare = receiveShare
+	server.receiveShare = partial(receiveShare, scheduleNow=server.scheduleNow)
 	server.RaiseRedFlags = RaiseRedFlags
 	server.ShareTarget = config.ShareTarget
 	server.StaleWorkTimeout = config.StaleWorkTimeout
@@ -960,20 +1332,31 @@ if __name__ == "__main__":
 		server.TrustedForwarders = config.TrustedForwarders
 	server.ServerName = config.ServerName
 	
-	stratumsrv = StratumServer()
+	if StratumFrontendSockets:
+		# Frontends have the clients, and the core makes the jobs for them
+		stratumsrv = StratumCore()
+		for (i, sock) in enumerate(StratumFrontendSockets):
+			stratumsrv.addFrontend(sock, i)
+	else:
+		stratumsrv = StratumServer()
+		configureStratumServer(stratumsrv)
+		if not hasattr(config, 'StratumAddresses'):
+			config.StratumAddresses = ()
+		for a in config.StratumAddresses:
+			NetworkListener(stratumsrv, a)
 	stratumsrv.getStratumJob = getStratumJob
 	stratumsrv.getExistingStratumJob = getExistingStratumJob
-	stratumsrv.receiveShare = receiveShare
-	stratumsrv.RaiseRedFlags = RaiseRedFlags
+	stratumsrv.receiveShare = partial(receiveShare, scheduleNow=stratumsrv.scheduleNow)
+	stratumsrv.receiveShares = partial(receiveShares, scheduleNow=stratumsrv.scheduleNow)
 	stratumsrv.getTarget = getTarget
-	stratumsrv.defaultTarget = config.ShareTarget
+	stratumsrv.resetTarget = resetTarget
 	stratumsrv.IsJobValid = IsJobValid
-	stratumsrv.checkAuthentication = checkAuthentication
 	stratumsrv.WorkUpdateInterval = config.WorkUpdateInterval
-	if not hasattr(config, 'StratumAddresses'):
-		config.StratumAddresses = ()
-	for a in config.StratumAddresses:
-		NetworkListener(stratumsrv, a)
+	if hasattr(config, 'StratumJobCoalesceWindow'):
+		stratumsrv.JobCoalesceWindow = config.StratumJobCoalesceWindow
+	
+	for s in (bcnode, server, stratumsrv):
+		configureServer(s)
 	
 	MM.start()
 	
@@ -983,6 +1366,11 @@ if __name__ == "__main__":
 	prune_thr.daemon = True
 	prune_thr.start()
 	
+	if config.DynamicTargetting:
+		sweep_thr = threading.Thread(target=DynamicTargetSweeper)
+		sweep_thr.daemon = True
+		sweep_thr.start()
+	
 	bcnode_thr = threading.Thread(target=bcnode.serve_forever)
 	bcnode_thr.daemon = True
 	bcnode_thr.start()
@@ -83,8 +83,11 @@ class HTTPHandler(networkserver.SocketHandler):
 		if body is None:
 			self.push(buf)
 			return
-		buf += body
+		# Sent together, without copying the body
+		self.cork()
 		self.push(buf)
+		self.push(body)
+		self.uncork()
 		raise RequestHandled
 	
 	def doError(self, reason = '', code = 100, headers = None):
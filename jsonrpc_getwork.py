@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from binascii import b2a_hex
+import httpserver
 from jsonrpcserver import JSONRPCHandler
 import logging
 try:
@@ -24,7 +25,7 @@ except:
 	logging.getLogger('jsonrpc_getwork').warning('Error importing \'midstate\' module; work will not provide midstates')
 	midstate = None
 from struct import pack
-from util import RejectedShare, swap32
+from util import PendingValidation, RejectedShare, swap32
 
 _CheckForDupesHACK = {}
 _RealDupes = {}
@@ -80,11 +81,20 @@ class _getwork:
 			'userAgent': self.UA,
 			'submitProtocol': 'getwork',
 		}
+		onValidated = lambda rej: self.server.scheduleNow(lambda: self.submitworkValidated(rej), errHandler=self)
 		try:
-			self.server.receiveShare(share)
+			rv = self.server.receiveShare(share, onValidated)
 		except RejectedShare as rej:
 			self._JSONHeaders['X-Reject-Reason'] = str(rej)
 			return False
+		if rv is PendingValidation:
+			raise httpserver.AsyncRequest
 		return True
+	
+	def submitworkValidated(self, rej):
+		if isinstance(rej, RejectedShare):
+			self._JSONHeaders['X-Reject-Reason'] = str(rej)
+			rej = False
+		self.finishAsyncJSON(True if rej is None else rej)
 
 JSONRPCHandler._register(_getwork)
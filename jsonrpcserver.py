@@ -183,8 +183,12 @@ class JSONRPCHandler(httpserver.HTTPHandler):
 		finally:
 			self.server.tls.wantClear = False
 		if 'NELH' not in self.quirks:
-			rv = rv[1:]  # strip the '{' we already sent
-			self.push(('%x' % len(rv)).encode('utf8') + b"\r\n" + rv + b"\r\n0\r\n\r\n")
+			rv = memoryview(rv)[1:]  # strip the '{' we already sent
+			self.cork()
+			self.push(('%x' % len(rv)).encode('utf8') + b"\r\n")
+			self.push(rv)
+			self.push(b"\r\n0\r\n\r\n")
+			self.uncork()
 			self.reset_request()
 			return
 		
@@ -207,6 +211,9 @@ class JSONRPCHandler(httpserver.HTTPHandler):
 			self.logger.error(("Error during JSON-RPC call (UA=%s, IP=%s): %s%s\n" % (self.reqinfo.get('UA'), self.remoteHost, method, params)) + traceback.format_exc())
 			efun = self.fmtError if longpoll else self.doError
 			return efun(r'Service error: %s' % (e,))
+		return self._doJSON_reply(reqid, rv, longpoll)
+	
+	def _doJSON_reply(self, reqid, rv, longpoll = False):
 		rv = {'id': reqid, 'error': None, 'result': rv}
 		try:
 			rv = json.dumps(rv)
@@ -216,6 +223,22 @@ class JSONRPCHandler(httpserver.HTTPHandler):
 		rv = rv.encode('utf8')
 		return rv if longpoll else self.sendReply(200, rv, headers=self._JSONHeaders)
 	
+	# Completes a call which raised httpserver.AsyncRequest; rv may be an exception
+	def finishAsyncJSON(self, rv):
+		if self.fd == -1:
+			return
+		try:
+			if isinstance(rv, BaseException):
+				self.logger.error("Error during async JSON-RPC call (UA=%s, IP=%s): %s: %s" % (self.reqinfo.get('UA'), self.remoteHost, self.JSONRPCMethod, rv))
+				self.doError(r'Service error: %s' % (rv,))
+			else:
+				self._doJSON_reply(self.JSONRPCId, rv)
+			raise httpserver.RequestNotHandled
+		except httpserver.RequestHandled:
+			pass
+		finally:
+			self.reset_request()
+	
 	def doJSON(self, data, longpoll = False):
 		# TODO: handle JSON errors
 		try:
@@ -288,6 +311,7 @@ class JSONRPCServer(networkserver.AsyncSocketServer):
 	logger = logging.getLogger('JSONRPCServer')
 	
 	waker = True
+	schMT = True
 	
 	def __init__(self, *a, **ka):
 		ka.setdefault('RequestHandlerClass', JSONRPCHandler)
@@ -14,28 +14,50 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asynchat
+import asyncio
+from collections import deque
+from itertools import islice
 import logging
 import os
 import select
 import socket
 import threading
+from threading import get_ident
 from time import time
 import traceback
 from util import ScheduleDict, WithNoop, tryErr
-from errno import EHOSTUNREACH, ETIMEDOUT
+from errno import EBADF, ECONNABORTED, ECONNRESET, EEXIST, EHOSTUNREACH, ENOENT, ENOTCONN, EPIPE, ESHUTDOWN, ETIMEDOUT
 
 EPOLL_READ = select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | select.EPOLLHUP
 EPOLL_WRITE = select.EPOLLOUT
 
 _DISCONNECTED = frozenset((EHOSTUNREACH,ETIMEDOUT))
+_INF = float('inf')
+# Errors recv treats as the peer closing the connection
+_RECV_DISCONNECTED = frozenset((ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE, EBADF))
+
+try:
+	_IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+	_IOV_MAX = 0x400
+
+# Returns the length of the longest prefix of needle that haystack ends with
+def find_prefix_at_end(haystack, needle):
+	l = len(needle) - 1
+	while l and not haystack.endswith(needle[:l]):
+		l -= 1
+	return l
 
 class SocketHandler:
 	ac_in_buffer_size = 4096
 	ac_out_buffer_size = 4096
 	
+	# NOTE: Subclasses without __slots__ get a __dict__ as usual
+	__slots__ = ('ac_in_buffer', 'incoming', 'terminator', 'wbuf', 'wbytes', 'corked', 'closeme', 'server', 'socket', 'addr', '_Task', 'fd')
+	
 	def handle_close(self):
 		self.wbuf = None
+		self.wbytes = 0
 		self.close()
 	
 	def handle_error(self):
@@ -43,128 +65,314 @@ class SocketHandler:
 		self.handle_close()
 	
 	# NOTE: This function checks for socket-closed condition and calls handle_close
-	recv = asynchat.async_chat.recv
-	
-	def handle_read(self):
+	def recv(self, buffer_size):
 		try:
-			data = self.recv (self.ac_in_buffer_size)
+			data = self.socket.recv(buffer_size)
 		except socket.error as why:
-			# This silences some additional expected socket errors
-			# not automatically dealt with by asyncore.
-			if why.args[0] not in _DISCONNECTED:
-				self.handle_error()
-			else:
+			if why.args[0] in _RECV_DISCONNECTED:
 				self.handle_close()
-			return
+				return b''
+			raise
+		if not data:
+			# A closed connection is indicated by being readable, with nothing to read
+			self.handle_close()
+		return data
+	
+	def handle_read(self):
+		server = self.server
+		edge = server.EdgeTriggered
+		size = server.ReadSize if edge else self.ac_in_buffer_size
+		budget = server.ReadBudget
+		chunks = []
+		while True:
+			try:
+				data = self.recv(size)
+			except BlockingIOError:
+				# Drained
+				break
+			except socket.error as why:
+				# This silences some additional expected socket errors
+				# not automatically dealt with by asyncore.
+				if why.args[0] not in _DISCONNECTED:
+					self.handle_error()
+				else:
+					self.handle_close()
+				return
+			if not data:
+				break
+			chunks.append(data)
+			# Edge-triggered sockets must be read until they run dry
+			if not edge or len(data) < size:
+				break
+			budget -= len(data)
+			if budget <= 0:
+				# There may be more, but other connections get a turn first
+				server._Ready.append(self)
+				break
 		
-		if self.closeme:
+		if self.closeme or not chunks:
 			# All input is ignored from sockets we have "closed"
 			return
 		
-		if isinstance(data, str) and self.use_encoding:
-			data = bytes(str, self.encoding)
-		self.ac_in_buffer = self.ac_in_buffer + data
+		data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+		# An empty buffer is just replaced by data; a bytearray is extended in place
+		self.ac_in_buffer += data
 		
 		self.server.lastReadbuf = self.ac_in_buffer
 		
 		self.handle_readbuf()
 	
-	collect_incoming_data = asynchat.async_chat._collect_incoming_data
-	get_terminator = asynchat.async_chat.get_terminator
-	set_terminator = asynchat.async_chat.set_terminator
+	# incoming is a shared empty tuple until there is something to collect
+	def collect_incoming_data(self, data):
+		if self.incoming:
+			self.incoming.append(data)
+		else:
+			self.incoming = [data]
+	
+	def get_terminator(self):
+		return self.terminator
+	
+	# A terminator is bytes (or a tuple of alternatives), a byte count, or None
+	def set_terminator(self, term):
+		if isinstance(term, int) and term < 0:
+			raise ValueError('the number of received bytes must be positive')
+		self.terminator = term
 	
+	# Scans the buffer from a position instead of slicing off each line, and
+	# collects memoryviews of it; whatever is still unread is kept (compacted)
+	# once everything available has been handled
 	def handle_readbuf(self):
-		while self.ac_in_buffer:
-			lb = len(self.ac_in_buffer)
-			terminator = self.get_terminator()
-			if not terminator:
-				# no terminator, collect it all
-				self.collect_incoming_data (self.ac_in_buffer)
-				self.ac_in_buffer = b''
-			elif isinstance(terminator, int):
-				# numeric terminator
-				n = terminator
-				if lb < n:
-					self.collect_incoming_data (self.ac_in_buffer)
-					self.ac_in_buffer = b''
-					self.terminator = self.terminator - lb
+		buf = self.ac_in_buffer
+		lb = len(buf)
+		pos = 0
+		mv = memoryview(buf)
+		try:
+			while pos < lb:
+				terminator = self.get_terminator()
+				if not terminator:
+					# no terminator, collect it all
+					self.collect_incoming_data(mv[pos:])
+					pos = lb
+				elif isinstance(terminator, int):
+					# numeric terminator
+					n = terminator
+					if lb - pos < n:
+						self.collect_incoming_data(mv[pos:])
+						self.terminator = n - (lb - pos)
+						pos = lb
+					else:
+						self.collect_incoming_data(mv[pos:pos + n])
+						pos += n
+						self.terminator = 0
+						self.found_terminator()
 				else:
-					self.collect_incoming_data (self.ac_in_buffer[:n])
-					self.ac_in_buffer = self.ac_in_buffer[n:]
-					self.terminator = 0
-					self.found_terminator()
-			else:
-				# 3 cases:
-				# 1) end of buffer matches terminator exactly:
-				#    collect data, transition
-				# 2) end of buffer matches some prefix:
-				#    collect data to the prefix
-				# 3) end of buffer does not match any prefix:
-				#    collect data
-				# NOTE: this supports multiple different terminators, but
-				#       NOT ones that are prefixes of others...
-				if isinstance(self.ac_in_buffer, type(terminator)):
-					terminator = (terminator,)
-				termidx = tuple(map(self.ac_in_buffer.find, terminator))
-				try:
-					index = min(x for x in termidx if x >= 0)
-				except ValueError:
+					# 3 cases:
+					# 1) end of buffer matches terminator exactly:
+					#    collect data, transition
+					# 2) end of buffer matches some prefix:
+					#    collect data to the prefix
+					# 3) end of buffer does not match any prefix:
+					#    collect data
+					# NOTE: this supports multiple different terminators, but
+					#       NOT ones that are prefixes of others...
+					if isinstance(terminator, bytes):
+						terminator = (terminator,)
 					index = -1
-				if index != -1:
-					# we found the terminator
-					if index > 0:
-						# don't bother reporting the empty string (source of subtle bugs)
-						self.collect_incoming_data (self.ac_in_buffer[:index])
-					specific_terminator = terminator[termidx.index(index)]
-					terminator_len = len(specific_terminator)
-					self.ac_in_buffer = self.ac_in_buffer[index+terminator_len:]
-					# This does the Right Thing if the terminator is changed here.
-					self.found_terminator()
-				else:
-					# check for a prefix of the terminator
-					termidx = tuple(map(lambda a: asynchat.find_prefix_at_end (self.ac_in_buffer, a), terminator))
-					index = max(termidx)
-					if index:
-						if index != lb:
-							# we found a prefix, collect up to the prefix
-							self.collect_incoming_data (self.ac_in_buffer[:-index])
-							self.ac_in_buffer = self.ac_in_buffer[-index:]
-						break
+					for term in terminator:
+						x = buf.find(term, pos)
+						if x != -1 and (index == -1 or x < index):
+							index = x
+							specific_terminator = term
+					if index != -1:
+						# we found the terminator
+						if index > pos:
+							# don't bother reporting the empty string (source of subtle bugs)
+							self.collect_incoming_data(mv[pos:index])
+						pos = index + len(specific_terminator)
+						# This does the Right Thing if the terminator is changed here.
+						self.found_terminator()
 					else:
+						# check for a prefix of the terminator
+						tail = buf[max(pos, lb - max(map(len, terminator)) + 1):]
+						index = max(find_prefix_at_end(tail, a) for a in terminator)
+						if index == lb - pos:
+							# nothing but a prefix left
+							break
+						if index:
+							# we found a prefix, collect up to the prefix
+							self.collect_incoming_data(mv[pos:lb - index])
+							pos = lb - index
+							break
 						# no prefix, collect it all
-						self.collect_incoming_data (self.ac_in_buffer)
-						self.ac_in_buffer = b''
+						self.collect_incoming_data(mv[pos:])
+						pos = lb
+				if self.ac_in_buffer is not buf:
+					# Replaced (eg, by boot)
+					break
+		finally:
+			# Collected data kept for later must not pin the buffer
+			incoming = self.incoming
+			if incoming and isinstance(incoming[-1], memoryview):
+				self.incoming = list(bytes(x) if isinstance(x, memoryview) else x for x in incoming)
+			# Nothing may still export buf, or it can't be compacted in place
+			incoming = None
+			mv.release()
+			self._trimInput(buf, pos)
+	
+	# Drops the first pos bytes of buf, which were handled, from the input buffer
+	def _trimInput(self, buf, pos):
+		if self.ac_in_buffer is not buf:
+			return
+		if pos >= len(buf):
+			self.ac_in_buffer = b''
+			return
+		if isinstance(buf, bytearray):
+			try:
+				del buf[:pos]
+				return
+			except BufferError:
+				# Something still has a memoryview of it
+				pass
+		# Later reads are appended in place
+		self.ac_in_buffer = bytearray(buf[pos:])
 	
 	def push(self, data):
-		if not len(self.wbuf):
+		if not self.corked is None:
+			self.corked.append(data)
+			return
+		server = self.server
+		if server.CoalesceWrites and server._LoopThread == get_ident():
+			# Sent along with anything else pushed this iteration
+			self.corked = [data]
+			server._Corked.append(self)
+			return
+		self._send(data)
+	
+	def _send(self, data):
+		if self.wbuf is None:
+			return
+		bs = 0
+		if not self.wbuf:
 			# Try to send as much as we can immediately
 			try:
 				bs = self.socket.send(data)
+				self.server.WriteStats['send'] += 1
 			except:
 				# Chances are we'll fail later, but anyway...
 				bs = 0
-			data = data[bs:]
-			if not len(data):
+			if bs == len(data):
 				return
-		self.wbuf += data
-		self.server.register_socket_m(self.fd, EPOLL_READ | EPOLL_WRITE)
+		self._queue((data,), bs)
+	
+	# Queues chunks to send once the socket is writable, less the first bs
+	# bytes, which were already sent; nothing is copied
+	def _queue(self, chunks, bs = 0):
+		wbuf = self.wbuf
+		wasEmpty = not wbuf
+		if wasEmpty:
+			wbuf = deque()
+		for data in chunks:
+			n = len(data)
+			if bs:
+				if bs >= n:
+					bs -= n
+					continue
+				data = memoryview(data)[bs:]
+				n -= bs
+				bs = 0
+			wbuf.append(data)
+			self.wbytes += n
+		if wasEmpty and wbuf:
+			self.wbuf = wbuf
+			self.server.register_socket_m(self.fd, EPOLL_READ | EPOLL_WRITE)
+	
+	# While corked, pushed data is only queued, and uncork sends it all at once
+	def cork(self):
+		if self.corked is None:
+			self.corked = []
+	
+	def uncork(self):
+		server = self.server
+		if server.CoalesceWrites and server._LoopThread == get_ident():
+			# The server sends it at the end of the iteration
+			if self.corked:
+				server._Corked.append(self)
+			else:
+				# Nothing will flush an empty cork, so later pushes must not go into it
+				self.corked = None
+			return
+		self.flushCorked()
+	
+	def flushCorked(self):
+		data = self.corked
+		self.corked = None
+		if not data or self.fd == -1 or self.wbuf is None:
+			return
+		if len(data) == 1:
+			self._send(data[0])
+			return
+		bs = 0
+		if not self.wbuf:
+			# Gather everything into one syscall
+			try:
+				bs = self.socket.sendmsg(data if len(data) <= _IOV_MAX else data[:_IOV_MAX])
+				self.server.WriteStats['sendmsg'] += 1
+			except:
+				bs = 0
+		self._queue(data, bs)
 	
 	def handle_timeout(self):
 		self.close()
 	
 	def handle_write(self):
-		if self.wbuf is None:
+		wbuf = self.wbuf
+		if wbuf is None:
 			# Socket was just closed by remote peer
 			return
-		bs = self.socket.send(self.wbuf)
-		self.wbuf = self.wbuf[bs:]
-		if not len(self.wbuf):
+		edge = self.server.EdgeTriggered
+		while wbuf:
+			if len(wbuf) == 1:
+				want = len(wbuf[0])
+				try:
+					bs = self.socket.send(wbuf[0])
+				except BlockingIOError:
+					if not edge:
+						raise
+					break
+				self.server.WriteStats['send'] += 1
+			else:
+				chunks = list(islice(wbuf, _IOV_MAX))
+				want = sum(map(len, chunks))
+				try:
+					bs = self.socket.sendmsg(chunks)
+				except BlockingIOError:
+					if not edge:
+						raise
+					break
+				self.server.WriteStats['sendmsg'] += 1
+			self.wbytes -= bs
+			sent = bs
+			while bs:
+				n = len(wbuf[0])
+				if bs < n:
+					wbuf[0] = memoryview(wbuf[0])[bs:]
+					break
+				wbuf.popleft()
+				bs -= n
+			# Edge-triggered sockets are written until they are full
+			if not edge or sent < want:
+				break
+		if not wbuf:
+			# Drop the deque while idle
+			self.wbuf = ()
 			if self.closeme:
 				self.close()
 				return
 			self.server.register_socket_m(self.fd, EPOLL_READ)
 	
 	def close(self):
+		if self.corked:
+			self.flushCorked()
 		if self.wbuf:
 			self.closeme = True
 			return
@@ -193,14 +401,19 @@ class SocketHandler:
 	
 	def __init__(self, server, sock, addr):
 		self.ac_in_buffer = b''
-		self.incoming = []
-		self.wbuf = b''
+		self.incoming = ()
+		# Output not sent yet, as a deque of chunks (or an empty tuple), and its size in bytes
+		self.wbuf = ()
+		self.wbytes = 0
+		self.corked = None
 		self.closeme = False
 		self.server = server
 		self.socket = sock
 		self.addr = addr
 		self._Task = None
 		self.fd = sock.fileno()
+		# The event loop must never block on a socket (BitcoinLink connects blocking)
+		sock.setblocking(False)
 		server.register_socket(self.fd, self)
 		server.connections[id(self)] = self
 		self.changeTask(self.handle_timeout, time() + 15)
@@ -219,10 +432,13 @@ class SocketHandler:
 class NetworkListener:
 	logger = logging.getLogger('SocketListener')
 	
-	def __init__(self, server, server_address, address_family = socket.AF_INET6):
+	# With reuse_port, other processes may bind the same address (also with
+	# SO_REUSEPORT), and the kernel spreads new connections among them
+	def __init__(self, server, server_address, address_family = socket.AF_INET6, reuse_port = False):
 		self.server = server
 		self.server_address = server_address
 		self.address_family = address_family
+		self.reuse_port = reuse_port
 		tryErr(self.setup_socket, server_address, Logger=self.logger, ErrorMsg=server_address)
 	
 	def _makebind_py(self, server_address):
@@ -232,6 +448,8 @@ class NetworkListener:
 			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		except socket.error:
 			pass
+		if self.reuse_port:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		sock.bind(server_address)
 		return sock
 	
@@ -284,17 +502,145 @@ class _Waker:
 		self.logger = logging.getLogger('Waker for %s' % (server.__class__.__name__,))
 	
 	def handle_read(self):
-		data = os.read(self.fd, 1)
+		# Several wakeups may be waiting
+		data = os.read(self.fd, 0x100)
 		if not data:
 			self.logger.error('Got EOF on socket')
 		self.logger.debug('Read wakeup')
 
+# Runs an AsyncSocketServer on an asyncio event loop instead of its own epoll
+# loop. Handlers keep their non-blocking sockets and callbacks; the loop only
+# watches their descriptors (through the same interface as select.epoll), and
+# the schedule runs when a task is due or on wakeup, rather than every second
+class _AsyncioEngine:
+	def __init__(self, server):
+		self.server = server
+		self.loop = asyncio.new_event_loop()
+		self._masks = {}
+		self._timer = None
+		self._timerAt = None
+		self._flushing = False
+	
+	# Once the loop is running, only its own thread may change it
+	def _otherThread(self):
+		return self.loop.is_running() and self.server._LoopThread != get_ident()
+	
+	def register(self, fd, eventmask):
+		if fd in self._masks:
+			raise OSError(EEXIST, os.strerror(EEXIST))
+		self._masks[fd] = 0
+		self.modify(fd, eventmask)
+	
+	def modify(self, fd, eventmask):
+		if fd not in self._masks:
+			raise OSError(ENOENT, os.strerror(ENOENT))
+		if self._otherThread():
+			self.loop.call_soon_threadsafe(self._modify, fd, eventmask)
+		else:
+			self._modify(fd, eventmask)
+	
+	def _modify(self, fd, eventmask):
+		old = self._masks.get(fd)
+		if old is None:
+			# Unregistered since
+			return
+		self._masks[fd] = eventmask
+		loop = self.loop
+		if eventmask & EPOLL_READ:
+			if not old & EPOLL_READ:
+				loop.add_reader(fd, self._event, fd, EPOLL_READ)
+		elif old & EPOLL_READ:
+			loop.remove_reader(fd)
+		if eventmask & EPOLL_WRITE:
+			if not old & EPOLL_WRITE:
+				loop.add_writer(fd, self._event, fd, EPOLL_WRITE)
+		elif old & EPOLL_WRITE:
+			loop.remove_writer(fd)
+	
+	def unregister(self, fd):
+		if fd not in self._masks:
+			raise OSError(ENOENT, os.strerror(ENOENT))
+		if self._otherThread():
+			self.loop.call_soon_threadsafe(self._unregister, fd)
+		else:
+			self._unregister(fd)
+	
+	def _unregister(self, fd):
+		self._modify(fd, 0)
+		self._masks.pop(fd, None)
+	
+	def _event(self, fd, e):
+		server = self.server
+		o = server._fd.get(fd)
+		if o is None:
+			return
+		server.doing = 'events'
+		server._dispatch(o, e)
+		server.doing = 'poll'
+		if server._Corked and not self._flushing:
+			# Callbacks added now run after the rest of this iteration's events
+			self._flushing = True
+			self.loop.call_soon(self._flush)
+	
+	def _flush(self):
+		self._flushing = False
+		if self.server._Corked:
+			self.server.flushCorked()
+	
+	def tick(self):
+		server = self.server
+		if not server.keepgoing:
+			self.loop.stop()
+			return
+		server.doing = 'pre-schedule'
+		server.pre_schedule()
+		server.doing = 'schedule'
+		timeNow = time()
+		timeout = server._runSchedule(timeNow)
+		if server._Corked:
+			server.flushCorked()
+		if timeout >= 0:
+			self.wakeAt(timeNow + timeout)
+		server.doing = 'poll'
+	
+	def _timerFired(self):
+		self._timer = None
+		self._timerAt = None
+		self.tick()
+	
+	# Makes sure the schedule is run by time t
+	def wakeAt(self, t):
+		if self._otherThread():
+			self.loop.call_soon_threadsafe(self.wakeAt, t)
+			return
+		if not self._timerAt is None:
+			if self._timerAt <= t:
+				return
+			self._timer.cancel()
+		self._timerAt = t
+		self._timer = self.loop.call_later(max(0, t - time()), self._timerFired)
+	
+	def wakeup(self):
+		self.loop.call_soon_threadsafe(self.tick)
+	
+	def run(self):
+		loop = self.loop
+		asyncio.set_event_loop(loop)
+		loop.call_soon(self.tick)
+		try:
+			loop.run_forever()
+		finally:
+			asyncio.set_event_loop(None)
+
 class AsyncSocketServer:
 	logger = logging.getLogger('SocketServer')
 	
 	waker = False
 	schMT = False
 	
+	# 'epoll' or 'asyncio'; must be set before the server is created
+	EventLoop = 'epoll'
+	
 	def __init__(self, RequestHandlerClass):
 		if not hasattr(self, 'ServerName'):
 			self.ServerName = 'Eloipool'
@@ -304,9 +650,25 @@ class AsyncSocketServer:
 		self.running = False
 		self.keepgoing = True
 		self.rejecting = False
-		self.lastidle = 0
+		# When the loop sleeps until, for waking it if a task is scheduled sooner
+		self._wakeAt = 0
+		
+		# In edge-triggered mode (epoll only; set before serving), readable
+		# connections are read ReadSize bytes at a time until drained, or up to
+		# ReadBudget bytes before the others get a turn
+		self.EdgeTriggered = False
+		self.ReadSize = 0x10000
+		self.ReadBudget = 0x40000
+		self._Ready = []
 		
-		self._epoll = select.epoll()
+		if self.EventLoop == 'asyncio':
+			self._aio = _AsyncioEngine(self)
+			self._poller = self._aio
+		elif self.EventLoop == 'epoll':
+			self._aio = None
+			self._poller = select.epoll()
+		else:
+			raise ValueError('Unknown EventLoop: %s' % (self.EventLoop,))
 		self._fd = {}
 		self.connections = {}
 		
@@ -319,26 +681,41 @@ class AsyncSocketServer:
 		
 		self.TrustedForwarders = ()
 		
-		if self.waker:
+		# If enabled, data pushed from the event loop is sent once per
+		# iteration, for each connection
+		self.CoalesceWrites = False
+		self._LoopThread = None
+		self._Corked = []
+		self.WriteStats = {
+			'send': 0,
+			'sendmsg': 0,
+			'flushes': 0,
+		}
+		
+		if self.waker and not self._aio:
 			(r, w) = os.pipe()
 			o = _Waker(self, r)
 			self.register_socket(r, o)
 			self.waker = w
 	
 	def register_socket(self, fd, o, eventmask = EPOLL_READ):
-		self._epoll.register(fd, eventmask)
+		if self.EdgeTriggered and isinstance(o, SocketHandler):
+			eventmask |= select.EPOLLET
+		self._poller.register(fd, eventmask)
 		self._fd[fd] = o
 	
 	def register_socket_m(self, fd, eventmask):
+		if self.EdgeTriggered and isinstance(self._fd.get(fd), SocketHandler):
+			eventmask |= select.EPOLLET
 		try:
-			self._epoll.modify(fd, eventmask)
+			self._poller.modify(fd, eventmask)
 		except IOError:
 			raise socket.error
 	
 	def unregister_socket(self, fd):
 		del self._fd[fd]
 		try:
-			self._epoll.unregister(fd)
+			self._poller.unregister(fd)
 		except IOError:
 			raise socket.error
 	
@@ -347,6 +724,12 @@ class AsyncSocketServer:
 			self._sch[task] = startTime
 			if errHandler:
 				self._schEH[id(task)] = errHandler
+			wake = startTime < self._wakeAt
+		if self._aio:
+			self._aio.wakeAt(startTime)
+		elif wake and self.waker and self._LoopThread not in (None, get_ident()):
+			# The loop is sleeping past it
+			self.wakeup()
 		return task
 	
 	def rmSchedule(self, task):
@@ -359,7 +742,15 @@ class AsyncSocketServer:
 	def pre_schedule(self):
 		pass
 	
+	# NOTE: Safe to call from other threads only if both schMT and waker are enabled
+	def scheduleNow(self, task, errHandler=None):
+		self.schedule(task, time(), errHandler=errHandler)
+		self.wakeup()
+	
 	def wakeup(self):
+		if self._aio:
+			self._aio.wakeup()
+			return
 		if not self.waker:
 			raise NotImplementedError('Class `%s\' did not enable waker' % (self.__class__.__name__))
 		os.write(self.waker, b'\1')  # to break out of the epoll
@@ -372,68 +763,109 @@ class AsyncSocketServer:
 		for c in conns:
 			tryErr(lambda: c.boot())
 	
+	def flushCorked(self):
+		corked = self._Corked
+		self._Corked = []
+		self.WriteStats['flushes'] += 1
+		for o in corked:
+			if o.corked is None:
+				continue
+			try:
+				o.flushCorked()
+			except socket.error:
+				tryErr(o.handle_error)
+			except:
+				self.logger.error(traceback.format_exc())
+				tryErr(o.handle_error)
+	
+	# Runs the tasks that are due; returns seconds until the next one, or -1
+	def _runSchedule(self, timeNow):
+		while True:
+			with self._schLock:
+				if not len(self._sch):
+					self._wakeAt = _INF
+					return -1
+				timeNext = self._sch.nextTime()
+				if timeNow < timeNext:
+					self._wakeAt = timeNext
+					return timeNext - timeNow
+				f = self._sch.shift()
+			k = id(f)
+			EH = None
+			if k in self._schEH:
+				EH = self._schEH[k]
+				del self._schEH[k]
+			try:
+				f()
+			except socket.error:
+				if EH: tryErr(EH.handle_error)
+			except:
+				self.logger.error(traceback.format_exc())
+				if EH: tryErr(EH.handle_close)
+	
+	def _dispatch(self, o, e):
+		self.lastHandler = o
+		try:
+			if e & EPOLL_READ:
+				o.handle_read()
+			if e & EPOLL_WRITE:
+				o.handle_write()
+		except socket.error:
+			tryErr(o.handle_error)
+		except:
+			self.logger.error(traceback.format_exc())
+			tryErr(o.handle_error)
+	
 	def serve_forever(self):
 		self.running = True
+		self._LoopThread = get_ident()
+		if self._aio:
+			# asyncio watches descriptors level-triggered
+			self.EdgeTriggered = False
 		self.final_init()
+		if self._aio:
+			self._aio.run()
+		else:
+			self._serve_epoll()
+		if self._Corked:
+			self.flushCorked()
+		self._LoopThread = None
+		self.doing = None
+		self.running = False
+	
+	def _serve_epoll(self):
 		while self.keepgoing:
 			self.doing = 'pre-schedule'
 			self.pre_schedule()
 			self.doing = 'schedule'
 			timeNow = time()
-			if len(self._sch):
-				while True:
-					with self._schLock:
-						if not len(self._sch):
-							timeout = -1
-							break
-						timeNext = self._sch.nextTime()
-						if timeNow < timeNext:
-							timeout = timeNext - timeNow
-							break
-						f = self._sch.shift()
-					k = id(f)
-					EH = None
-					if k in self._schEH:
-						EH = self._schEH[k]
-						del self._schEH[k]
-					try:
-						f()
-					except socket.error:
-						if EH: tryErr(EH.handle_error)
-					except:
-						self.logger.error(traceback.format_exc())
-						if EH: tryErr(EH.handle_close)
-			else:
-				timeout = -1
-			if self.lastidle < timeNow - 1:
+			timeout = self._runSchedule(timeNow)
+			if self._Corked:
+				self.flushCorked()
+			if self._Ready:
 				timeout = 0
-			elif timeout < 0 or timeout > 1:
+			elif not self.waker and (timeout < 0 or timeout > 1):
+				# Nothing can wake us for new tasks or to stop
 				timeout = 1
 			
 			self.doing = 'poll'
 			try:
-				events = self._epoll.poll(timeout=timeout)
+				events = self._poller.poll(timeout=timeout)
 			except (IOError, select.error):
 				continue
 			except:
 				self.logger.error(traceback.format_exc())
 				continue
 			self.doing = 'events'
-			if not events:
-				self.lastidle = time()
+			# Connections that used up their read budget last time
+			ready = self._Ready
+			self._Ready = []
 			for (fd, e) in events:
 				o = self._fd.get(fd)
 				if o is None: continue
-				self.lastHandler = o
-				try:
-					if e & EPOLL_READ:
-						o.handle_read()
-					if e & EPOLL_WRITE:
-						o.handle_write()
-				except socket.error:
-					tryErr(o.handle_error)
-				except:
-					self.logger.error(traceback.format_exc())
-					tryErr(o.handle_error)
-		self.doing = None
-		self.running = False
+				self._dispatch(o, e)
+			for o in ready:
+				if o.fd != -1 and self._fd.get(o.fd) is o:
+					self._dispatch(o, EPOLL_READ)
+			if self._Corked:
+				self.flushCorked()
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+# Eloipool - Python Bitcoin pool server
+# Copyright (C) 2011-2013  Luke Dashjr <luke-jr+eloipool@utopios.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Captures shares (with the work they were issued against) from a running
+# server, and replays them offline through receiveShare to benchmark it:
+#     ./sharereplay.py [-c CONFIG] [-n ITERATIONS] share-capture
+
+from collections import deque
+import logging
+import pickle
+import threading
+from time import sleep
+import traceback
+from util import PendingValidation, RejectedShare
+
+class ShareCapture(threading.Thread):
+	logger = logging.getLogger('ShareCapture')
+	
+	def __init__(self, filename, limit = None):
+		super().__init__(name='ShareCapture')
+		self.daemon = True
+		self.fn = filename
+		self.limit = limit
+		self.count = 0
+		self._work = set()
+		self.queue = deque()
+		self.start()
+	
+	# Called with the share as submitted, and everything checkShare will look at
+	def capture(self, share, wluser, wli, work, currentBlock, lastBlock, networkTarget):
+		if not self.limit is None and self.count >= self.limit:
+			return
+		self.count += 1
+		if self.count == self.limit:
+			self.logger.info('Captured %d shares; stopping' % (self.count,))
+		
+		key = (wluser, wli)
+		if not work is None and key not in self._work:
+			self._work.add(key)
+			self.queue.append(('work', wluser, wli, work))
+		share = dict(share)
+		shareTime = share.pop('time')
+		share.pop('_stages', None)
+		self.queue.append(('share', share, wluser, wli, shareTime, currentBlock, lastBlock, networkTarget))
+	
+	def flush(self):
+		if not self.queue:
+			return
+		with open(self.fn, 'ab') as f:
+			while self.queue:
+				pickle.dump(self.queue.popleft(), f)
+	
+	def run(self):
+		while True:
+			try:
+				sleep(1)
+				self.flush()
+			except:
+				self.logger.critical(traceback.format_exc())
+
+def loadCapture(fn):
+	work = {}
+	shares = []
+	with open(fn, 'rb') as f:
+		while True:
+			try:
+				r = pickle.load(f)
+			except EOFError:
+				break
+			if r[0] == 'work':
+				(cmd, wluser, wli, wle) = r
+				work[(wluser, wli)] = wle
+			else:
+				shares.append(r[1:])
+	return (work, shares)
+
+class _StubMerkleMaker:
+	currentBlock = (None, None, None)
+	lastBlock = (None, None, None)
+	
+	def updateBlock(self, *a, **k):
+		pass
+
+class _StubStratumServer:
+	def quickDifficultyUpdate(self, username):
+		pass
+
+class ShareReplay:
+	def __init__(self, eloipool, work, shares):
+		self.eloipool = eloipool
+		self.work = work
+		self.shares = shares
+		self.clock = [0]
+		
+		# Nothing may reach bitcoind, gotwork, share loggers, or miners
+		E = eloipool
+		E.MM = _StubMerkleMaker()
+		E.stratumsrv = _StubStratumServer()
+		E.blockSubmissionThread = lambda *a: None
+		E.bcnode.submitBlock = lambda payload: None
+		E.gotwork = None
+		del E.loggersShare[:]
+		# Shares are checked at the time they were originally received
+		E.time = lambda: self.clock[0]
+	
+	def reset(self):
+		E = self.eloipool
+		E.workLog.clear()
+		for (wluser, wli), wle in self.work.items():
+			E.workLog.setdefault(wluser, {})[wli] = wle
+		E.DupeShares.clear()
+		del E.RBDs[:]
+		del E.RBPs[:]
+	
+	def _prepare(self, r):
+		(share, wluser, wli, shareTime, currentBlock, lastBlock, networkTarget) = r
+		E = self.eloipool
+		E.MM.currentBlock = currentBlock
+		E.MM.lastBlock = lastBlock
+		E.networkTarget = networkTarget
+		self.clock[0] = shareTime
+		return dict(share)
+	
+	@staticmethod
+	def _reason(e):
+		if e is None:
+			return 'accepted'
+		if isinstance(e, BaseException):
+			return str(e) if isinstance(e, RejectedShare) else 'ERROR'
+		return e
+	
+	# Returns {(protocol, reason): [count, seconds]}
+	def run(self):
+		from time import perf_counter
+		E = self.eloipool
+		stats = {}
+		for r in self.shares:
+			share = self._prepare(r)
+			k = share.get('submitProtocol')
+			t0 = perf_counter()
+			try:
+				E.receiveShare(share)
+				rej = None
+			except BaseException as e:
+				rej = e
+			dt = perf_counter() - t0
+			s = stats.setdefault((k, self._reason(rej)), [0, 0.])
+			s[0] += 1
+			s[1] += dt
+		return stats
+	
+	# Like run, but through receiveShares (and ShareValidator, if any)
+	# Only the total time of each batch is known, so the cost is split evenly
+	def runBatched(self, batchSize):
+		from time import perf_counter
+		E = self.eloipool
+		stats = {}
+		results = deque()
+		done = threading.Semaphore(0)
+		pending = 0
+		
+		def onValidated(share, rej):
+			results.append((share.get('submitProtocol'), self._reason(rej), None))
+			done.release()
+		
+		t0 = perf_counter()
+		for i in range(0, len(self.shares), batchSize):
+			batch = []
+			for r in self.shares[i:i + batchSize]:
+				share = self._prepare(r)
+				batch.append((share, lambda rej, share=share: onValidated(share, rej)))
+			t1 = perf_counter()
+			rvs = E.receiveShares(batch)
+			dt = (perf_counter() - t1) / len(batch)
+			for (share, cb), rv in zip(batch, rvs):
+				if rv is PendingValidation:
+					pending += 1
+					continue
+				results.append((share.get('submitProtocol'), self._reason(rv), dt))
+		for i in range(pending):
+			done.acquire()
+		total = perf_counter() - t0
+		
+		for (k, reason, dt) in results:
+			s = stats.setdefault((k, reason), [0, 0.])
+			s[0] += 1
+			s[1] += total / len(results) if dt is None else dt
+		return stats
+
+def _report(stats, elapsed, allocs):
+	n = sum(s[0] for s in stats.values())
+	print('%d shares in %.3f seconds: %.0f shares/s' % (n, elapsed, n / elapsed if elapsed else 0))
+	print('%-10s %-20s %10s %12s %10s' % ('protocol', 'result', 'count', 'total ms', 'us/share'))
+	for (k, reason), (count, t) in sorted(stats.items(), key=lambda i: (str(i[0][0]), i[0][1])):
+		print('%-10s %-20s %10d %12.3f %10.2f' % (k, reason, count, t * 1e3, t * 1e6 / count))
+	if allocs:
+		(gcs, blocks, peak) = allocs
+		print('gen0 collections: %d (%.2f per 1000 shares)' % (gcs, gcs * 1000. / n if n else 0))
+		print('net allocated blocks: %d' % (blocks,))
+		if not peak is None:
+			print('peak traced memory: %d bytes' % (peak,))
+
+def main():
+	import argparse
+	import gc
+	import sys
+	import time
+	
+	argparser = argparse.ArgumentParser(description='Replay captured shares through receiveShare')
+	argparser.add_argument('-c', '--config', help='Config name to load from config_<ARG>.py')
+	argparser.add_argument('-n', '--iterations', type=int, default=1, help='Times to replay the capture')
+	argparser.add_argument('-p', '--protocol', action='append', help='Only replay shares submitted with this protocol (stratum, getwork, GBT)')
+	argparser.add_argument('-b', '--batch', type=int, default=0, help='Replay through receiveShares, this many shares at a time')
+	argparser.add_argument('-v', '--validators', type=int, default=0, help='Use a ShareValidatorPool with this many processes (implies --batch)')
+	argparser.add_argument('--tracemalloc', action='store_true', help='Trace peak memory use (slow)')
+	argparser.add_argument('capture', help='File written by the ShareCapture config option')
+	args = argparser.parse_args()
+	
+	# eloipool parses its own arguments on import
+	sys.argv = sys.argv[:1]
+	if not args.config is None:
+		sys.argv += ['-c', args.config]
+	import eloipool
+	
+	(work, shares) = loadCapture(args.capture)
+	if args.protocol:
+		shares = list(r for r in shares if r[0].get('submitProtocol') in args.protocol)
+	print('Loaded %d shares and %d work entries' % (len(shares), len(work)))
+	if not shares:
+		return
+	
+	replay = ShareReplay(eloipool, work, shares)
+	if args.validators:
+		from sharevalidator import ShareValidatorPool
+		eloipool.ShareValidator = ShareValidatorPool(args.validators)
+		args.batch = args.batch or 0x10
+	
+	if args.tracemalloc:
+		import tracemalloc
+		tracemalloc.start()
+	
+	for i in range(args.iterations):
+		replay.reset()
+		gc.collect()
+		gcs = gc.get_stats()[0]['collections']
+		blocks = sys.getallocatedblocks()
+		if args.tracemalloc:
+			tracemalloc.reset_peak()
+		t0 = time.perf_counter()
+		if args.batch:
+			stats = replay.runBatched(args.batch)
+		else:
+			stats = replay.run()
+		elapsed = time.perf_counter() - t0
+		peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+		allocs = (gc.get_stats()[0]['collections'] - gcs, sys.getallocatedblocks() - blocks, peak)
+		
+		print('Iteration %d:' % (i + 1,))
+		_report(stats, elapsed, allocs)
+
+if __name__ == "__main__":
+	main()
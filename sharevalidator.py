@@ -0,0 +1,248 @@
+# Eloipool - Python Bitcoin pool server
+# Copyright (C) 2011-2013  Luke Dashjr <luke-jr+eloipool@utopios.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from copy import deepcopy
+from hashlib import sha256
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import threading
+from time import perf_counter
+import traceback
+from util import dblsha, LEhash2int
+
+# NOTE: Everything in this module above ShareValidatorPool must be safe to run
+#       in a worker process, where only the job descriptor and the arguments
+#       are available (no workLog, no merkleMaker, no servers)
+
+_CoinbaseFlags = (b'/P2SH/', b'NOP2SH', b'p2sh/CHV', b'p2sh/NOCHV')
+
+def checkCoinbase(coinbase, cbpreLen):
+	# Filter out known "I support" flags, to prevent exploits
+	for ff in _CoinbaseFlags:
+		if coinbase.find(ff) > max(-1, cbpreLen - len(ff)):
+			return 'bad-cb-flag'
+	
+	if len(coinbase) > 100:
+		return 'bad-cb-length'
+	
+	return None
+
+def checkHash(data, workTarget):
+	blkhash = dblsha(data)
+	if blkhash[28:] != b'\0\0\0\0':
+		return (blkhash, 'H-not-zero')
+	if LEhash2int(blkhash) > workTarget:
+		return (blkhash, 'high-hash')
+	return (blkhash, None)
+
+# Everything needed to check shares for a stratum job, precomputed once per job
+class StratumJob:
+	def __init__(self, merkleTree, workCoinbase, extranonceSize):
+		cbtxn = deepcopy(merkleTree.data[0])
+		cb = workCoinbase + b'\0' * extranonceSize
+		cbtxn.setCoinbase(cb)
+		cbtxn.assemble()
+		pos = cbtxn.data.index(cb) + len(workCoinbase)
+		self.coinbasePrefix = cbtxn.data[:pos]
+		self.coinbaseSuffix = cbtxn.data[pos + extranonceSize:]
+		self.extranonceSize = extranonceSize
+		self.workCoinbase = workCoinbase
+		self.steps = tuple(merkleTree._steps)
+		self.versionBytes = merkleTree.MP['_BlockVersionBytes']
+		self.cbtxn = cbtxn
+		self._prefixHash = sha256(self.coinbasePrefix)
+	
+	# hashlib objects can't be pickled, so rebuild the prefix state on the other side
+	def __getstate__(self):
+		d = self.__dict__.copy()
+		del d['_prefixHash']
+		return d
+	
+	def __setstate__(self, d):
+		self.__dict__.update(d)
+		self._prefixHash = sha256(self.coinbasePrefix)
+	
+	def coinbaseTxnData(self, extranonce):
+		if len(extranonce) != self.extranonceSize:
+			# The coinbase length changes, so it can't just be spliced in
+			cbtxn = deepcopy(self.cbtxn)
+			cbtxn.setCoinbase(self.workCoinbase + extranonce)
+			cbtxn.assemble()
+			return cbtxn.data
+		return self.coinbasePrefix + extranonce + self.coinbaseSuffix
+	
+	def coinbaseTxid(self, extranonce):
+		if len(extranonce) != self.extranonceSize:
+			return dblsha(self.coinbaseTxnData(extranonce))
+		h = self._prefixHash.copy()
+		h.update(extranonce)
+		h.update(self.coinbaseSuffix)
+		return sha256(h.digest()).digest()
+
+def checkHeader(job, data, workTarget):
+	(blkhash, hashReject) = checkHash(data, workTarget)
+	return (data, blkhash, hashReject, None)
+
+# versionBytes replaces the job's version, if the miner rolled it
+# If stages is a list, (stage, perf_counter()) marks are added to it
+def checkStratumShare(job, extranonce, ntime, nonce, prevBlock, bits, workTarget, versionBytes = None, stages = None):
+	merkleRoot = job.coinbaseTxid(extranonce)
+	if stages:
+		stages.append(('coinbase', perf_counter()))
+	for s in job.steps:
+		merkleRoot = dblsha(merkleRoot + s)
+	if stages:
+		stages.append(('merkle', perf_counter()))
+	
+	data = (versionBytes or job.versionBytes) + prevBlock + merkleRoot + ntime[::-1] + bits + nonce[::-1]
+	(blkhash, hashReject) = checkHash(data, workTarget)
+	return (data, blkhash, hashReject, checkCoinbase(job.workCoinbase + extranonce, len(job.workCoinbase)))
+
+def _worker(conn, maxJobs):
+	jobs = OrderedDict()
+	while True:
+		try:
+			msg = conn.recv()
+		except EOFError:
+			break
+		if msg[0] == 'job':
+			(cmd, jobkey, job) = msg
+			jobs[jobkey] = job
+			if len(jobs) > maxJobs:
+				jobs.popitem(False)
+			continue
+		
+		(cmd, shares) = msg
+		results = []
+		for (reqid, jobkey, func, args) in shares:
+			try:
+				job = None if jobkey is None else jobs[jobkey]
+				rv = (True, func(job, *args))
+			except BaseException as e:
+				rv = (False, traceback.format_exc())
+			results.append((reqid, rv))
+		conn.send(results)
+
+class _Worker:
+	def __init__(self, ctx, n, maxJobs):
+		(self.conn, cconn) = ctx.Pipe()
+		self.process = ctx.Process(target=_worker, args=(cconn, maxJobs), name='ShareValidator %d' % (n,))
+		self.process.daemon = True
+		self.process.start()
+		cconn.close()
+		self.lock = threading.Lock()
+		self.jobs = OrderedDict()
+		self.pending = {}
+		self.alive = True
+
+class ShareValidatorPool:
+	logger = logging.getLogger('ShareValidatorPool')
+	
+	# NOTE: Must be created before any other threads are started, since the
+	#       worker processes are forked
+	def __init__(self, processes, maxJobs = 0x100):
+		ctx = multiprocessing.get_context('fork')
+		self.maxJobs = maxJobs
+		self._workers = list(_Worker(ctx, i, maxJobs) for i in range(processes))
+		self._lock = threading.Lock()
+		self._reqid = 0
+		
+		thr = threading.Thread(target=self._collector, name='ShareValidatorPool collector')
+		thr.daemon = True
+		thr.start()
+	
+	# Runs func(job, *args) in a worker process; jobf is only called if that
+	# worker doesn't have the job yet. The callback is called from the
+	# collector thread with either the result or an exception.
+	# Returns False if no worker is available, in which case the caller
+	# should check the share inline.
+	def validate(self, jobkey, jobf, func, args, callback):
+		return self.validateMany(((jobkey, jobf, func, args, callback),))
+	
+	# Like validate, for a list of (jobkey, jobf, func, args, callback)
+	# All of them are sent to the same worker in one message, and their
+	# results come back together
+	def validateMany(self, shares):
+		with self._lock:
+			workers = list(w for w in self._workers if w.alive)
+			if not workers:
+				return False
+			reqid = self._reqid + 1
+			self._reqid += len(shares)
+		w = workers[reqid % len(workers)]
+		msg = []
+		try:
+			with w.lock:
+				for (jobkey, jobf, func, args, callback) in shares:
+					w.pending[reqid] = callback
+					msg.append((reqid, jobkey, func, args))
+					if jobkey not in w.jobs:
+						w.conn.send(('job', jobkey, jobf()))
+						w.jobs[jobkey] = None
+						if len(w.jobs) > self.maxJobs:
+							w.jobs.popitem(False)
+					reqid += 1
+				w.conn.send(('shares', msg))
+		except (OSError, EOFError):
+			self.logger.error(traceback.format_exc())
+			self._forget(w, msg)
+			self._workerDied(w)
+			return False
+		except:
+			self._forget(w, msg)
+			raise
+		return True
+	
+	def _forget(self, w, msg):
+		with w.lock:
+			for m in msg:
+				w.pending.pop(m[0], None)
+	
+	def _workerDied(self, w):
+		if not w.alive:
+			return
+		w.alive = False
+		self.logger.critical('%s died; %d shares lost' % (w.process.name, len(w.pending)))
+		with w.lock:
+			pending = w.pending
+			w.pending = {}
+		for callback in pending.values():
+			callback(RuntimeError('%s died' % (w.process.name,)))
+	
+	def _collector(self):
+		while True:
+			conns = dict((w.conn, w) for w in self._workers if w.alive)
+			if not conns:
+				self.logger.critical('No share validator processes left; checking shares inline')
+				return
+			for conn in wait(tuple(conns)):
+				w = conns[conn]
+				try:
+					results = conn.recv()
+				except EOFError:
+					self._workerDied(w)
+					continue
+				for (reqid, (ok, rv)) in results:
+					with w.lock:
+						callback = w.pending.pop(reqid)
+					if not ok:
+						rv = RuntimeError(rv)
+					try:
+						callback(rv)
+					except:
+						self.logger.error(traceback.format_exc())
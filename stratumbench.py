@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# Eloipool - Python Bitcoin pool server
+# Copyright (C) 2011-2013  Luke Dashjr <luke-jr+eloipool@utopios.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the memory each (idle, subscribed and authorized) stratum
+# connection costs, not counting its socket object or kernel buffers:
+#     ./stratumbench.py [-n CONNECTIONS] [-j JOBS]
+# With --loop, instead runs a live server on each event loop given, and
+# measures over localhost how fast CONNECTIONS clients connect, subscribe and
+# authorize; how long new jobs take to reach all of them; and how many shares
+# per second are answered:
+#     ./stratumbench.py --loop epoll --loop epoll-et --loop asyncio [-n CONNECTIONS] [-s SHARES] [-r ROUNDS]
+
+import argparse
+import gc
+import multiprocessing
+import networkserver
+import resource
+import selectors
+import socket
+import sys
+import threading
+from time import time
+import tracemalloc
+from stratumserver import StratumHandler, StratumServer
+from util import bdiff1target
+
+def _setJob(server, n):
+	JobId = 'job %d' % (n,)
+	JobBytes = ('{"id": null, "method": "mining.notify", "params": ["%s"]}\n' % (JobId,)).encode('ascii')
+	server.JobId = JobId
+	server.JobBlobs = (JobId, JobBytes, {})
+
+class _Client:
+	__slots__ = ('sock', 'buf', 'results', 'notified')
+	
+	def __init__(self, sock):
+		self.sock = sock
+		self.buf = b''
+		self.results = 0
+		self.notified = None
+
+# Reads lines from every client until done() is true
+def _readClients(sel, onLine, done):
+	while not done():
+		events = sel.select(timeout=30)
+		if not events:
+			raise TimeoutError('server stopped answering')
+		for (key, mask) in events:
+			c = key.data
+			data = c.sock.recv(0x10000)
+			if not data:
+				raise EOFError('server closed a connection')
+			lines = (c.buf + data).split(b'\n')
+			c.buf = lines.pop()
+			for line in lines:
+				onLine(c, line)
+
+def _onLine(c, line):
+	if b'"result"' in line:
+		c.results += 1
+	elif b'mining.notify' in line:
+		c.notified = (time(), line)
+
+# Runs in its own process, so the clients do not compete with the server for the GIL
+def _clients(pipe, port, n, shares):
+	sel = selectors.DefaultSelector()
+	clients = []
+	# Keep the listen backlog from overflowing
+	window = 64
+	start = time()
+	while len(clients) < n:
+		while len(clients) < n and sum(1 for c in clients[-window:] if c.results < 2) < window:
+			i = len(clients)
+			sock = socket.create_connection(('127.0.0.1', port))
+			sock.sendall(('{"id": 1, "method": "mining.subscribe", "params": []}\n{"id": 2, "method": "mining.authorize", "params": ["miner%d", ""]}\n' % (i,)).encode('ascii'))
+			c = _Client(sock)
+			sel.register(sock, selectors.EVENT_READ, c)
+			clients.append(c)
+		_readClients(sel, _onLine, lambda: all(c.results >= 2 for c in clients[-window:]))
+	pipe.send(time() - start)
+	
+	while True:
+		cmd = pipe.recv()
+		if cmd is None:
+			break
+		(job, t0) = cmd
+		want = ('"job %d"' % (job,)).encode('ascii')
+		_readClients(sel, _onLine, lambda: all(c.notified and want in c.notified[1] for c in clients))
+		latencies = sorted(c.notified[0] - t0 for c in clients)
+		pipe.send((latencies[len(latencies) // 2], latencies[-1]))
+	
+	for c in clients:
+		c.results = 0
+	start = time()
+	for i in range(n):
+		line = '{"id": 3, "method": "mining.submit", "params": ["miner%d", "%s", "00000000", "504e86b9", "%%08x"]}\n' % (i, want.decode('ascii').strip('"'))
+		clients[i].sock.sendall(''.join(line % (j,) for j in range(shares)).encode('ascii'))
+	_readClients(sel, _onLine, lambda: all(c.results >= shares for c in clients))
+	pipe.send(time() - start)
+	for c in clients:
+		c.sock.close()
+
+def _acceptShare(share, onValidated = None):
+	share['target'] = bdiff1target
+
+def _loopBench(engine, args):
+	n = args.connections
+	# epoll-et is epoll in edge-triggered mode
+	StratumServer.EventLoop = engine.split('-')[0]
+	server = StratumServer()
+	server.EdgeTriggered = engine.endswith('-et')
+	server.defaultTarget = bdiff1target
+	server.receiveShare = _acceptShare
+	_setJob(server, 0)
+	listener = networkserver.NetworkListener(server, ('127.0.0.1', 0), socket.AF_INET)
+	port = listener.socket.getsockname()[1]
+	thread = threading.Thread(target=server.serve_forever)
+	thread.start()
+	
+	(pipe, childpipe) = multiprocessing.Pipe()
+	child = multiprocessing.Process(target=_clients, args=(childpipe, port, n, args.shares))
+	child.start()
+	childpipe.close()
+	try:
+		connectTime = pipe.recv()
+		notify = []
+		for job in range(1, args.rounds + 1):
+			t0 = time()
+			pipe.send((job, t0))
+			_setJob(server, job)
+			server.WakeRequest = 1
+			server.wakeup()
+			notify.append(pipe.recv())
+		pipe.send(None)
+		shareTime = pipe.recv()
+	finally:
+		child.join()
+		server.keepgoing = False
+		server.wakeup()
+		thread.join()
+		server.boot_all()
+		listener.socket.close()
+	
+	notify = list(zip(*notify))
+	return (
+		engine,
+		n / connectTime,
+		sum(notify[0]) / len(notify[0]) * 1000,
+		max(notify[1]) * 1000,
+		n * args.shares / shareTime,
+	)
+
+def main():
+	argparser = argparse.ArgumentParser(description='Measure memory used per stratum connection')
+	argparser.add_argument('-n', '--connections', type=int, default=1000, help='Connections to open')
+	argparser.add_argument('-j', '--jobs', type=int, default=8, help='Jobs to send each connection')
+	argparser.add_argument('--loop', action='append', choices=('epoll', 'epoll-et', 'asyncio'), help='Benchmark a live server on this event loop instead')
+	argparser.add_argument('-s', '--shares', type=int, default=100, help='Shares each connection submits (with --loop)')
+	argparser.add_argument('-r', '--rounds', type=int, default=10, help='New jobs to broadcast (with --loop)')
+	args = argparser.parse_args()
+	n = args.connections
+	
+	# Each connection is a socketpair (or a client and server socket), plus a few spare descriptors
+	(soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+	want = n * 2 + 0x40
+	if soft < want:
+		resource.setrlimit(resource.RLIMIT_NOFILE, (min(want, hard), hard))
+	
+	if args.loop:
+		print('%d connections, %d shares each, %d new jobs' % (n, args.shares, args.rounds))
+		print('%-8s %12s %16s %16s %12s' % ('loop', 'connects/s', 'notify avg ms', 'notify max ms', 'shares/s'))
+		for engine in args.loop:
+			print('%-8s %12.0f %16.2f %16.2f %12.0f' % _loopBench(engine, args))
+		return
+	
+	server = StratumServer()
+	server.defaultTarget = bdiff1target
+	_setJob(server, 0)
+	socks = list(socket.socketpair() for i in range(n))
+	
+	gc.collect()
+	tracemalloc.start()
+	blocks = sys.getallocatedblocks()
+	mem = tracemalloc.get_traced_memory()[0]
+	
+	handlers = []
+	for i in range(n):
+		h = StratumHandler(server, socks[i][0], ('192.0.2.%d' % (i % 0x100,), 3333))
+		h._stratum_mining_subscribe()
+		h._stratum_mining_authorize('miner%d' % (i,))
+		handlers.append(h)
+	# Run everything the new connections scheduled (first job, UA request,
+	# license notice) as the event loop would, so they are left idle
+	while server._sch:
+		task = server._sch.shift()
+		server._schEH.pop(id(task), None)
+		task()
+	for j in range(args.jobs):
+		_setJob(server, j + 1)
+		for h in handlers:
+			h.sendJob()
+	
+	gc.collect()
+	mem = tracemalloc.get_traced_memory()[0] - mem
+	blocks = sys.getallocatedblocks() - blocks
+	tracemalloc.stop()
+	
+	print('%d connections, %d jobs each' % (n, args.jobs))
+	print('%.0f bytes per connection' % (mem / n,))
+	print('%.1f allocated blocks per connection' % (blocks / n,))
+	if handlers:
+		print('%d bytes per handler object' % (sys.getsizeof(handlers[0]),))
+
+if __name__ == "__main__":
+	main()
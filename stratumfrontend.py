@@ -0,0 +1,408 @@
+# Eloipool - Python Bitcoin pool server
+# Copyright (C) 2011-2013  Luke Dashjr <luke-jr+eloipool@utopios.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Stratum can be served by several frontend processes (each with its own
+# GIL), which all bind the stratum addresses with SO_REUSEPORT, so the kernel
+# spreads miners among them. Frontends parse requests, authenticate miners and
+# send them jobs; the core process (StratumCore) keeps making the jobs,
+# checking and logging shares, and tracking targets. Each frontend talks to
+# the core over a Unix socket pair, with length-prefixed pickled messages:
+#     core to frontend:
+#         job      (JobId, JobBytes, broadcast, rejecting), once per job
+#         targets  ([(TargetKey, target), ...], how), changed by the core
+#         results  ([(share id, accepted target, None or exception), ...])
+#         transactions (request id, [hex, ...] or None for an unknown job)
+#     frontend to core:
+#         shares           ([(share id, share), ...])
+#         resetTarget      (TargetKey, RequestedTarget)
+#         resumeTarget     (TargetKey)
+#         releaseTarget    (TargetKey), once its connection is closed
+#         getTransactions  (request id, jobid)
+#         updateJob        (wantClear)
+
+import collections
+import logging
+import multiprocessing
+import networkserver
+import pickle
+import socket
+import struct
+from stratumserver import StratumAsyncReply, StratumHandler, StratumServer
+from time import time
+import traceback
+from util import PendingValidation, RejectedShare, tryErr
+
+_MsgLength = struct.Struct('!I')
+
+class _Link(networkserver.SocketHandler):
+	def __init__(self, *a, **ka):
+		super().__init__(*a, **ka)
+		# Links never time out
+		self.changeTask(None)
+		self.MsgLength = None
+		self.set_terminator(_MsgLength.size)
+	
+	def send(self, *msg):
+		data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+		self.push(_MsgLength.pack(len(data)) + data)
+	
+	def found_terminator(self):
+		data = b''.join(self.incoming)
+		self.incoming = ()
+		if self.MsgLength is None:
+			self.MsgLength = _MsgLength.unpack(data)[0]
+			self.set_terminator(self.MsgLength)
+			return
+		self.MsgLength = None
+		self.set_terminator(_MsgLength.size)
+		
+		try:
+			msg = pickle.loads(data)
+			getattr(self, '_msg_%s' % (msg[0],))(*msg[1:])
+		except:
+			# Only this message is lost, not the link
+			self.logger.error('Error handling message:\n' + traceback.format_exc())
+	
+	def handle_close(self):
+		lost = self.fd != -1
+		super().handle_close()
+		if lost:
+			self.linkLost()
+
+class _CoreLink(_Link):
+	logger = logging.getLogger('StratumFrontend')
+	
+	def _msg_job(self, JobId, JobBytes, broadcast, rejecting):
+		self.server._coreJob(JobId, JobBytes, broadcast, rejecting)
+	
+	def _msg_targets(self, targets, how):
+		self.server._coreTargets(targets, how)
+	
+	def _msg_results(self, results):
+		self.server._coreResults(results)
+	
+	def _msg_transactions(self, reqid, txns):
+		self.server._coreTransactions(reqid, txns)
+	
+	def linkLost(self):
+		self.server._coreLost()
+
+class _FrontendHandler(StratumHandler):
+	__slots__ = ()
+	
+	def _stratum_mining_get_transactions(self, jobid):
+		# Only the core has them
+		self.server.requestTransactions(self, self.RPCId, jobid)
+		raise StratumAsyncReply
+
+# Runs in each frontend process, with its clients
+class StratumFrontend(StratumServer):
+	logger = logging.getLogger('StratumFrontend')
+	
+	def __init__(self, coreSocket, *a, **ka):
+		ka.setdefault('RequestHandlerClass', _FrontendHandler)
+		super().__init__(*a, **ka)
+		# {TargetKey: target} as last sent by the core
+		self._Targets = {}
+		# {share id: (share, onValidated)} being checked by the core
+		self._CoreShares = {}
+		self._ShareId = 0
+		# {request id: (client, rpcid, jobid)} waiting for transactions from the core
+		self._TxnRequests = {}
+		self._TxnRequestId = 0
+		self.Core = _CoreLink(self, coreSocket, 'core')
+	
+	def getTarget(self, TargetKey, now):
+		return self._Targets.get(TargetKey)
+	
+	def resetTarget(self, TargetKey, now, RequestedTarget = None):
+		# Usually the default target, until the core says otherwise
+		self._Targets[TargetKey] = None
+		self.Core.send('resetTarget', TargetKey, RequestedTarget)
+	
+	def resumeTarget(self, TargetKey):
+		# Until the core says otherwise
+		self._Targets[TargetKey] = None
+		self.Core.send('resumeTarget', TargetKey)
+	
+	def releaseTarget(self, TargetKey):
+		self._Targets.pop(TargetKey, None)
+		if self.Core.fd != -1:
+			self.Core.send('releaseTarget', TargetKey)
+	
+	def requestTransactions(self, ic, rpcid, jobid):
+		self._TxnRequestId += 1
+		self._TxnRequests[self._TxnRequestId] = (ic, rpcid, jobid)
+		self.Core.send('getTransactions', self._TxnRequestId, jobid)
+	
+	def receiveShare(self, share, onValidated = None):
+		return self.receiveShares(((share, onValidated),))[0]
+	
+	def receiveShares(self, shares):
+		batch = []
+		for (share, onValidated) in shares:
+			self._ShareId += 1
+			self._CoreShares[self._ShareId] = (share, onValidated)
+			batch.append((self._ShareId, share))
+		self.Core.send('shares', batch)
+		return [PendingValidation] * len(batch)
+	
+	# Jobs are only made by the core (this happens if a quick update races a new job)
+	def updateJobOnly(self, wantClear = False, forceClean = False):
+		self.Core.send('updateJob', wantClear)
+	
+	def boot_all(self):
+		for c in tuple(self.connections.values()):
+			if not c is self.Core:
+				tryErr(c.boot)
+	
+	def _coreJob(self, JobId, JobBytes, broadcast, rejecting):
+		if rejecting:
+			if not self.rejecting:
+				self.logger.warning('Core is rejecting stratum: disabling')
+				self.rejecting = True
+				self.boot_all()
+			return
+		elif self.rejecting:
+			self.rejecting = False
+			self.logger.info('Core is accepting stratum again: reenabling')
+		self.JobBytes = JobBytes
+		self.JobId = JobId
+		self.JobBlobs = (JobId, JobBytes, {})
+		if broadcast:
+			self.WakeRequest = 1
+			self.wakeup()
+	
+	# how is 'quick' for targets the core retargetted early (clients get a
+	# job at them right away), 'reset' to answer resetTarget (clients that
+	# already have a job get it again at the new target), or None
+	def _coreTargets(self, targets, how):
+		T = self._Targets
+		changed = set()
+		for (TargetKey, target) in targets:
+			if TargetKey not in T:
+				# Released since
+				continue
+			if T.get(TargetKey) != target:
+				changed.add(TargetKey)
+			T[TargetKey] = target
+		if how == 'quick':
+			self._PendingQuickUpdates.update(k for (k, t) in targets if k in T)
+			self.doQuickUpdate()
+		elif how == 'reset' and changed:
+			for ic in list(self._Clients.values()):
+				if ic.TargetKey in changed and ic.JobTargets:
+					try:
+						ic.sendJob()
+					except socket.error:
+						pass
+	
+	def _coreResults(self, results):
+		CS = self._CoreShares
+		for (shareId, target, rej) in results:
+			(share, onValidated) = CS.pop(shareId)
+			if rej is None:
+				share['target'] = target
+			onValidated(rej)
+	
+	def _coreTransactions(self, reqid, txns):
+		(ic, rpcid, jobid) = self._TxnRequests.pop(reqid)
+		ic.sendResult(rpcid, KeyError(jobid) if txns is None else txns)
+	
+	def _coreLost(self):
+		self.logger.critical('Lost the core process; stopping')
+		CS = self._CoreShares
+		self._CoreShares = {}
+		for (share, onValidated) in CS.values():
+			onValidated(RuntimeError('core unavailable'))
+		self._TxnRequests = {}
+		self.keepgoing = False
+		self.wakeup()
+
+class _FrontendLink(_Link):
+	logger = logging.getLogger('StratumCore')
+	
+	def __init__(self, *a, **ka):
+		super().__init__(*a, **ka)
+		# {TargetKey: target} as last sent to the frontend
+		self.Targets = {}
+		self.Results = collections.deque()
+		self._flushResultsTask = self.flushResults
+	
+	def sendJob(self, broadcast, now):
+		server = self.server
+		if broadcast:
+			# Targets may have changed without a quick update (eg, swept), and
+			# a single process would have looked them up for each client
+			changed = []
+			T = self.Targets
+			for TargetKey in T:
+				target = server.getTarget(TargetKey, now)
+				if target != T[TargetKey]:
+					T[TargetKey] = target
+					changed.append((TargetKey, target))
+			if changed:
+				self.send('targets', changed, None)
+		JobBytes = getattr(server, 'JobBytes', None)
+		if JobBytes is None and not server.rejecting:
+			return
+		self.send('job', server.JobId, JobBytes, broadcast, server.rejecting)
+	
+	def _result(self, shareId, share, rej):
+		if rej is None:
+			return (shareId, share['target'], None)
+		if not isinstance(rej, RejectedShare):
+			# Only the message is needed, and other exceptions might not pickle
+			rej = RuntimeError(str(rej))
+		return (shareId, None, rej)
+	
+	# Called from other threads (ShareValidator)
+	def _queueResult(self, shareId, share, rej):
+		self.Results.append(self._result(shareId, share, rej))
+		self.server.scheduleNow(self._flushResultsTask)
+	
+	def flushResults(self):
+		R = self.Results
+		results = []
+		while R:
+			results.append(R.popleft())
+		if results and self.fd != -1:
+			self.send('results', results)
+	
+	def _msg_shares(self, shares):
+		batch = []
+		for (shareId, share) in shares:
+			onValidated = lambda rej, shareId=shareId, share=share: self._queueResult(shareId, share, rej)
+			batch.append((share, onValidated))
+		rvs = self.server.receiveShares(batch)
+		for ((shareId, share), rv) in zip(shares, rvs):
+			if rv is PendingValidation:
+				continue
+			self.Results.append(self._result(shareId, share, rv))
+		self.flushResults()
+	
+	def _msg_resetTarget(self, TargetKey, RequestedTarget):
+		server = self.server
+		target = server.resetTarget(TargetKey, time(), RequestedTarget)
+		self.Targets[TargetKey] = target
+		server._TargetLinks[TargetKey] = self
+		self.send('targets', ((TargetKey, target),), 'reset')
+	
+	def _msg_resumeTarget(self, TargetKey):
+		server = self.server
+		target = server.getTarget(TargetKey, time())
+		self.Targets[TargetKey] = target
+		server._TargetLinks[TargetKey] = self
+		self.send('targets', ((TargetKey, target),), 'reset')
+	
+	# Connections closed are forgotten, rather than looked up at every broadcast
+	def _msg_releaseTarget(self, TargetKey):
+		self.Targets.pop(TargetKey, None)
+		TL = self.server._TargetLinks
+		if TL.get(TargetKey) is self:
+			del TL[TargetKey]
+	
+	def _msg_getTransactions(self, reqid, jobid):
+		try:
+			txns = self.server.getTransactions(jobid)
+		except KeyError:
+			txns = None
+		self.send('transactions', reqid, txns)
+	
+	def _msg_updateJob(self, wantClear):
+		self.server.updateJob(wantClear=wantClear)
+	
+	def linkLost(self):
+		self.logger.critical('Stratum %s exited; its miners are disconnected' % (self.addr,))
+		server = self.server
+		server.Frontends.remove(self)
+		TL = server._TargetLinks
+		for TargetKey in self.Targets:
+			if TL.get(TargetKey) is self:
+				del TL[TargetKey]
+
+# Runs in the core process, instead of a StratumServer with clients
+class StratumCore(StratumServer):
+	logger = logging.getLogger('StratumCore')
+	
+	def __init__(self, *a, **ka):
+		super().__init__(*a, **ka)
+		self.Frontends = []
+		# {TargetKey: frontend link} for quick updates
+		self._TargetLinks = {}
+	
+	def addFrontend(self, sock, n):
+		self.Frontends.append(_FrontendLink(self, sock, 'frontend %d' % (n,)))
+	
+	def boot_all(self):
+		# Frontends boot their clients when they get a job while rejecting
+		for c in tuple(self.connections.values()):
+			if not isinstance(c, _FrontendLink):
+				tryErr(c.boot)
+	
+	def _wakeNodes(self):
+		now = time()
+		for link in self.Frontends:
+			link.sendJob(True, now)
+		super()._wakeNodes()
+	
+	def doQuickUpdate(self):
+		PQU = self._PendingQuickUpdates
+		self._PendingQuickUpdates = set()
+		now = time()
+		updates = {}
+		for TargetKey in PQU:
+			link = self._TargetLinks.get(TargetKey)
+			if link is None:
+				continue
+			target = self.getTarget(TargetKey, now)
+			link.Targets[TargetKey] = target
+			updates.setdefault(link, []).append((TargetKey, target))
+		if not updates:
+			return
+		
+		# Clients most likely have the current job, so make a new one for the
+		# new targets to apply to; only these frontends need it before the
+		# next broadcast
+		req = self._takeUpdateRequest()
+		self.updateJobOnly(wantClear=True, forceClean=True)
+		if not req is None:
+			self._jobUpdated()
+		for (link, targets) in updates.items():
+			link.sendJob(False, now)
+			link.send('targets', targets, 'quick')
+		self.logger.debug('Quickupdated %d targets' % (len(PQU),))
+
+def _frontendMain(run, index, count, sock, coreSockets):
+	# Only the core may keep its ends open, so frontends notice it exiting
+	for s in coreSockets:
+		s.close()
+	run(index, count, sock)
+
+# Forks count frontend processes, each calling run(index, count, socket), and
+# returns the core's ends of their sockets
+# NOTE: Must be called before any other threads are started
+def startFrontends(count, run):
+	ctx = multiprocessing.get_context('fork')
+	coreSockets = []
+	for i in range(count):
+		(core, frontend) = socket.socketpair()
+		p = ctx.Process(target=_frontendMain, args=(run, i, count, frontend, coreSockets + [core]), name='StratumFrontend %d' % (i,))
+		p.daemon = True
+		p.start()
+		frontend.close()
+		coreSockets.append(core)
+	return coreSockets
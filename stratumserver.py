@@ -15,26 +15,95 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import agplcompliance
-from binascii import b2a_hex
+from binascii import a2b_hex, b2a_hex
 import collections
-from copy import deepcopy
 import json
 import logging
 import networkserver
+import re
 import socket
 import struct
+import threading
 from time import time
 import traceback
-from util import RejectedShare, swap32, target2bdiff, UniqueSessionIdManager
+from util import bdiff1target, DurationHistogram, PendingValidation, RejectedShare, swap32, target2bdiff, UniqueSessionIdManager
 
 extranonce2sz = 4
 
+# Connections' dynamic targets are kept (in userStatus) under this, plus their session id
+TargetKeyPrefix = 'stratum session '
+
 class StratumError(BaseException):
 	def __init__(self, errno, msg, tb = True):
 		self.StratumErrNo = errno
 		self.StratumErrMsg = msg
 		self.StratumTB = tb
 
+# Raised by methods which will send their reply later (with sendResult)
+class StratumAsyncReply(BaseException):
+	pass
+
+# mining.submit is nearly all of our traffic, so it is parsed straight from the
+# line when it has the usual shape and only plain ASCII strings; anything else
+# goes through json
+def _submitRE(order):
+	items = {
+		'params': rb'"params"\s*:\s*\[\s*"(?P<username>[ !#-\[\]-~]*)"\s*,\s*"(?P<jobid>[ !#-\[\]-~]*)"' +
+		          rb'\s*,\s*"(?P<extranonce2>[0-9A-Fa-f]*)"\s*,\s*"(?P<ntime>[0-9A-Fa-f]*)"\s*,\s*"(?P<nonce>[0-9A-Fa-f]*)"' +
+		          rb'\s*(?:,\s*"(?P<versionbits>[0-9A-Fa-f]*)"\s*)?\]',
+		'id': rb'"id"\s*:\s*(?P<id>-?\d+|null|"[ !#-\[\]-~]*")',
+		'method': rb'"method"\s*:\s*"mining\.submit"',
+	}
+	return re.compile(rb'\s*\{\s*' + rb'\s*,\s*'.join(items[k] for k in order) + rb'\s*\}\s*\Z')
+
+# The most common orders first
+_SubmitREs = tuple(_submitRE(order) for order in (
+	('params', 'id', 'method'),
+	('id', 'method', 'params'),
+	('method', 'params', 'id'),
+	('id', 'params', 'method'),
+	('params', 'method', 'id'),
+	('method', 'id', 'params'),
+))
+
+# Returns (id, params) for a mining.submit line, or None
+def _parseSubmit(line):
+	for r in _SubmitREs:
+		m = r.match(line)
+		if m:
+			break
+	else:
+		return None
+	(username, jobid, extranonce2, ntime, nonce, versionbits, rpcid) = m.group('username', 'jobid', 'extranonce2', 'ntime', 'nonce', 'versionbits', 'id')
+	if rpcid == b'null':
+		rpcid = None
+	elif rpcid[0] == 0x22:
+		rpcid = rpcid[1:-1].decode('ascii')
+	else:
+		rpcid = int(rpcid)
+	params = [username.decode('ascii'), jobid.decode('ascii'), extranonce2, ntime, nonce]
+	if not versionbits is None:
+		params.append(versionbits)
+	return (rpcid, params)
+
+# Replies to mining.submit are encoded once for each result; only the id differs
+_SubmitReplies = {}
+
+def _submitReply(rpcid, rv):
+	key = True if rv is True else (rv.StratumErrNo, rv.StratumErrMsg)
+	try:
+		(pre, post) = _SubmitReplies[key]
+	except KeyError:
+		error = None if rv is True else (rv.StratumErrNo, rv.StratumErrMsg, None)
+		pre = (json.dumps({'error': error})[:-1] + ', "id": ').encode('ascii')
+		post = (', "result": ' + json.dumps(True if rv is True else None) + '}\n').encode('ascii')
+		_SubmitReplies[key] = (pre, post)
+	if type(rpcid) is int:
+		rpcid = b'%d' % (rpcid,)
+	else:
+		rpcid = json.dumps(rpcid).encode('ascii')
+	return pre + rpcid + post
+
 StratumCodes = {
 	'stale-prevblk': 21,
 	'stale-work': 21,
@@ -43,31 +112,115 @@ StratumCodes = {
 	'high-hash': 23,
 }
 
+# The targets of the last few jobs sent to a connection, as a fixed ring of
+# [jobid, target, ...]
+class JobTargetRing:
+	__slots__ = ('_ring', '_pos')
+	
+	def __init__(self, size = 5):
+		self._ring = [None] * (size * 2)
+		self._pos = 0
+	
+	def add(self, jobid, target):
+		ring = self._ring
+		pos = self._pos
+		ring[pos] = jobid
+		ring[pos + 1] = target
+		pos += 2
+		self._pos = 0 if pos == len(ring) else pos
+	
+	def get(self, jobid, default = None):
+		# NOTE: Job ids are strings and targets are ints, so only ids can match
+		try:
+			i = self._ring.index(jobid)
+		except ValueError:
+			return default
+		target = self._ring[i + 1]
+		return default if target is None else target
+	
+	def __contains__(self, jobid):
+		return not self.get(jobid) is None
+	
+	def __len__(self):
+		return len(self._ring) // 2 - self._ring[1::2].count(None)
+
+# Per-connection state is kept in slots (and shared empty values where
+# possible), since there may be a great many mostly idle connections
 class StratumHandler(networkserver.SocketHandler):
 	logger = logging.getLogger('StratumHandler')
 	
+	__slots__ = ('remoteHost', 'Usernames', 'lastBDiff', 'JobTargets', 'UA', 'LicenseSent', 'SubmitBatch', 'PendingResults', '_flushResultsTask', 'RecentWork', 'VersionRollingMask', 'TargetKey', 'SuggestedTarget', 'RPCId', 'extranonce1', '_sid')
+	
+	_PendingResultsLock = threading.Lock()
+	
 	def __init__(self, *a, **ka):
 		super().__init__(*a, **ka)
 		self.remoteHost = self.addr[0]
 		self.changeTask(None)
 		self.server.schedule(self.sendLicenseNotice, time() + 4, errHandler=self)
 		self.set_terminator(b"\n")
-		self.Usernames = {}
+		self.Usernames = ()
 		self.lastBDiff = None
-		self.JobTargets = collections.OrderedDict()
+		self.JobTargets = JobTargetRing()
 		self.UA = None
 		self.LicenseSent = agplcompliance._SourceFiles is None
+		self.SubmitBatch = None
+		# Only created once a share is checked by ShareValidator
+		self.PendingResults = None
+		self._flushResultsTask = None
+		# Accepted difficulty, decayed at each broadcast; the busiest miners get new jobs first
+		self.RecentWork = 0.
+		self.VersionRollingMask = None
+		# Dynamic targets are per connection, kept under this name once subscribed
+		self.TargetKey = None
+		self.SuggestedTarget = None
 	
 	def sendReply(self, ob):
 		return self.push(json.dumps(ob).encode('ascii') + b"\n")
 	
+	# Shares pipelined together are checked as a batch after everything in the
+	# buffer is parsed (or before replying to any other request, so replies
+	# stay in order), and all the replies are sent at once
+	def handle_readbuf(self):
+		if not getattr(self.server, 'receiveShares', None):
+			return super().handle_readbuf()
+		self.SubmitBatch = []
+		self.cork()
+		try:
+			super().handle_readbuf()
+			self.checkSubmitBatch()
+		finally:
+			self.SubmitBatch = None
+			self.uncork()
+	
+	def checkSubmitBatch(self):
+		batch = self.SubmitBatch
+		if not batch:
+			return
+		self.SubmitBatch = []
+		rvs = self.server.receiveShares(list((share, onValidated) for (rpcid, share, onValidated) in batch))
+		for (rpcid, share, onValidated), rv in zip(batch, rvs):
+			if rv is PendingValidation:
+				self.server.PendingShares += 1
+				continue
+			self.sendResult(rpcid, self._submitResult(rv, share))
+	
 	def found_terminator(self):
+		inbuf = b"".join(self.incoming)
+		self.incoming = ()
+		
+		if b'"mining.submit"' in inbuf:
+			submit = _parseSubmit(inbuf)
+			if submit:
+				(rpcid, params) = submit
+				self._handleRPC(rpcid, self._stratum_mining_submit, params)
+				return
+		
 		try:
-			inbuf = b"".join(self.incoming).decode('ascii')
+			inbuf = inbuf.decode('ascii')
 		except:
 			self.boot()
 			return
-		self.incoming = []
 		
 		if not inbuf:
 			return
@@ -89,6 +242,7 @@ class StratumHandler(networkserver.SocketHandler):
 			return
 		funcname = '_stratum_%s' % (rpc['method'].replace('.', '_'),)
 		if not hasattr(self, funcname):
+			self.checkSubmitBatch()
 			self.sendReply({
 				'error': [-3, "Method '%s' not found" % (rpc['method'],), None],
 				'id': rpc['id'],
@@ -96,35 +250,71 @@ class StratumHandler(networkserver.SocketHandler):
 			})
 			return
 		
+		self._handleRPC(rpc['id'], getattr(self, funcname), rpc['params'])
+	
+	def _handleRPC(self, rpcid, func, params):
+		self.RPCId = rpcid
+		if func != self._stratum_mining_submit:
+			# Submits before this request are answered first
+			self.checkSubmitBatch()
 		try:
-			rv = getattr(self, funcname)(*rpc['params'])
+			rv = func(*params)
+		except StratumAsyncReply:
+			return
 		except StratumError as e:
+			# A submit rejected before it could join the batch
+			self.checkSubmitBatch()
+			if not e.StratumTB:
+				self.push(_submitReply(rpcid, e))
+				return
 			self.sendReply({
-				'error': (e.StratumErrNo, e.StratumErrMsg, traceback.format_exc() if e.StratumTB else None),
-				'id': rpc['id'],
+				'error': (e.StratumErrNo, e.StratumErrMsg, traceback.format_exc()),
+				'id': rpcid,
 				'result': None,
 			})
 			return
 		except BaseException as e:
 			fexc = traceback.format_exc()
+			self.checkSubmitBatch()
 			self.sendReply({
 				'error': (20, str(e), fexc),
-				'id': rpc['id'],
+				'id': rpcid,
 				'result': None,
 			})
 			if not hasattr(e, 'StratumQuiet'):
 				self.logger.debug(fexc)
 			return
 		
-		if rpc['id'] is None:
+		if rpcid is None:
 			return
 		
+		if rv is True:
+			self.push(_submitReply(rpcid, rv))
+			return
 		self.sendReply({
 			'error': None,
-			'id': rpc['id'],
+			'id': rpcid,
 			'result': rv,
 		})
 	
+	def sendResult(self, rpcid, rv):
+		if rpcid is None or self.fd == -1:
+			return
+		if rv is True or isinstance(rv, StratumError):
+			self.push(_submitReply(rpcid, rv))
+		elif isinstance(rv, BaseException):
+			self.sendReply({
+				'error': (20, str(rv), None),
+				'id': rpcid,
+				'result': None,
+			})
+		else:
+			self.sendReply({
+				'error': None,
+				'id': rpcid,
+				'result': rv,
+			})
+	
 	def sendLicenseNotice(self):
 		if self.fd == -1:
 			return
@@ -138,24 +328,38 @@ class StratumHandler(networkserver.SocketHandler):
 	
 	def sendJob(self):
 		target = self.server.defaultTarget
-		if len(self.Usernames) == 1:
-			dtarget = self.server.getTarget(next(iter(self.Usernames)), time())
+		if not self.TargetKey is None:
+			dtarget = self.server.getTarget(self.TargetKey, time())
 			if not dtarget is None:
 				target = dtarget
-		bdiff = target2bdiff(target)
-		if self.lastBDiff != bdiff:
-			self.sendReply({
+		(JobId, JobBytes, blobs) = self.server.JobBlobs
+		try:
+			(bdiff, blob) = blobs[target]
+		except KeyError:
+			bdiff = target2bdiff(target)
+			blob = json.dumps({
 				'id': None,
 				'method': 'mining.set_difficulty',
 				'params': [
 					bdiff
 				],
-			})
+			}).encode('ascii') + b"\n" + JobBytes
+			blobs[target] = (bdiff, blob)
+		if self.lastBDiff != bdiff:
+			self.push(blob)
 			self.lastBDiff = bdiff
-		self.push(self.server.JobBytes)
-		if len(self.JobTargets) > 4:
-			self.JobTargets.popitem(False)
-		self.JobTargets[self.server.JobId] = target
+		else:
+			self.push(JobBytes)
+		self.JobTargets.add(JobId, target)
+	
+	# Asks the miner to move to another server, and drops it if it doesn't
+	def sendReconnect(self, host, port, wait = 0):
+		self.sendReply({
+			'id': None,
+			'method': 'client.reconnect',
+			'params': (host, port, wait),
+		})
+		self.changeTask(self.handle_timeout, time() + wait + 5)
 	
 	def requestStratumUA(self):
 		self.sendReply({
@@ -167,17 +371,51 @@ class StratumHandler(networkserver.SocketHandler):
 	def _stratumreply_7(self, rpc):
 		self.UA = rpc.get('result') or rpc
 	
+	# Returns the session id a reconnecting miner asked for, if it is still
+	# reserved; some miners send the mining.notify subscription id instead
+	@staticmethod
+	def _resumeSid(xid):
+		if not isinstance(xid, str):
+			return None
+		sz = UniqueSessionIdManager.size()
+		if len(xid) == sz * 2 + 1:
+			xid = xid[:-1]
+		try:
+			xid = bytes.fromhex(xid)
+			if len(xid) != sz:
+				return None
+			return UniqueSessionIdManager.getSpecific(struct.unpack('=I', xid)[0])  # NOTE: Assumes sessionids are 4 bytes
+		except (KeyError, ValueError):
+			return None
+	
 	def _stratum_mining_subscribe(self, UA = None, xid = None):
 		if not UA is None:
 			self.UA = UA
+		resumed = False
 		if not hasattr(self, '_sid'):
-			self._sid = UniqueSessionIdManager.get()
+			sid = self._resumeSid(xid)
+			if sid is None:
+				sid = UniqueSessionIdManager.get()
+				self.server._Sessions.pop(sid, None)
+			else:
+				# Jobs sent before the disconnect are still valid for it
+				session = self.server._Sessions.pop(sid, None)
+				if not session is None:
+					self.JobTargets = session[1]
+					resumed = True
+			self._sid = sid
 		if self.server._Clients.get(self._sid) not in (self, None):
 			del self._sid
 			raise self.server.RaiseRedFlags(RuntimeError('issuing duplicate sessionid'))
 		xid = struct.pack('=I', self._sid)  # NOTE: Assumes sessionids are 4 bytes
 		self.extranonce1 = xid
 		xid = b2a_hex(xid).decode('ascii')
+		self.TargetKey = TargetKeyPrefix + xid
+		if not resumed:
+			# Session ids are reused, so start the target over
+			self.server.resetTarget(self.TargetKey, time(), self.SuggestedTarget)
+		else:
+			self.server.resumeTarget(self.TargetKey)
 		self.server._Clients[id(self)] = self
 		self.changeTask(self.sendJob, 0)
 		return [
@@ -191,7 +429,13 @@ class StratumHandler(networkserver.SocketHandler):
 	
 	def close(self):
 		if hasattr(self, '_sid'):
-			UniqueSessionIdManager.put(self._sid)
+			# Reserved until its work is stale, so the miner can resume the session
+			expiry = time() + self.server.StaleWorkTimeout
+			if not self.server._Sessions:
+				self.server.schedule(self.server._pruneSessionsTask, expiry)
+			self.server._Sessions[self._sid] = (expiry, self.JobTargets)
+			self.server.releaseTarget(self.TargetKey)
+			UniqueSessionIdManager.put(self._sid, delay=True)
 			delattr(self, '_sid')
 		try:
 			del self.server._Clients[id(self)]
@@ -199,7 +443,56 @@ class StratumHandler(networkserver.SocketHandler):
 			pass
 		super().close()
 	
-	def _stratum_mining_submit(self, username, jobid, extranonce2, ntime, nonce):
+	# BIP310
+	def _stratum_mining_configure(self, extensions, params = None):
+		# Some miners send a list (or nothing) instead of an object
+		if not isinstance(params, dict):
+			params = {}
+		if not isinstance(extensions, list):
+			extensions = ()
+		rv = {}
+		for ext in extensions:
+			if ext == 'version-rolling':
+				try:
+					mask = int(params.get('version-rolling.mask', 'ffffffff'), 16)
+				except (TypeError, ValueError):
+					raise StratumError(20, 'bad-version-rolling-mask', False)
+				mask &= self.server.VersionRollingMask
+				self.VersionRollingMask = mask
+				rv['version-rolling'] = bool(mask)
+				rv['version-rolling.mask'] = '%08x' % (mask,)
+			else:
+				rv[ext] = False
+		return rv
+	
+	# Used as the initial target (within the pool's limits), or to start over
+	def _suggestTarget(self, target):
+		self.SuggestedTarget = target
+		if self.TargetKey is None:
+			return
+		self.server.resetTarget(self.TargetKey, time(), target)
+		if self.JobTargets:
+			self.sendJob()
+	
+	def _stratum_mining_suggest_difficulty(self, difficulty):
+		try:
+			difficulty = float(difficulty)
+			if difficulty <= 0:
+				raise ValueError
+		except (TypeError, ValueError):
+			raise StratumError(20, 'bad-difficulty', False)
+		self._suggestTarget(int(bdiff1target / difficulty))
+		return True
+	
+	def _stratum_mining_suggest_target(self, target):
+		try:
+			target = int(target, 16)
+		except (TypeError, ValueError):
+			raise StratumError(20, 'bad-target', False)
+		self._suggestTarget(target)
+		return True
+	
+	def _stratum_mining_submit(self, username, jobid, extranonce2, ntime, nonce, versionbits = None):
 		if username not in self.Usernames:
 			raise StratumError(24, 'unauthorized-user', False)
 		share = {
@@ -207,21 +500,65 @@ class StratumHandler(networkserver.SocketHandler):
 			'remoteHost': self.remoteHost,
 			'jobid': jobid,
 			'extranonce1': self.extranonce1,
-			'extranonce2': bytes.fromhex(extranonce2)[:extranonce2sz],
-			'ntime': bytes.fromhex(ntime),
-			'nonce': bytes.fromhex(nonce),
+			'extranonce2': a2b_hex(extranonce2)[:extranonce2sz],
+			'ntime': a2b_hex(ntime),
+			'nonce': a2b_hex(nonce),
 			'userAgent': self.UA,
 			'submitProtocol': 'stratum',
 		}
-		if jobid in self.JobTargets:
-			share['target'] = self.JobTargets[jobid]
+		if not versionbits is None:
+			share['versionbits'] = int(versionbits, 16)
+			share['versionmask'] = self.VersionRollingMask
+		target = self.JobTargets.get(jobid)
+		if not target is None:
+			share['target'] = target
+		if not self.TargetKey is None:
+			share['targetKey'] = self.TargetKey
+		rpcid = self.RPCId
+		onValidated = lambda rej: self._queueResult(rpcid, share, rej)
+		if not self.SubmitBatch is None:
+			self.SubmitBatch.append((rpcid, share, onValidated))
+			raise StratumAsyncReply
 		try:
-			self.server.receiveShare(share)
+			rv = self.server.receiveShare(share, onValidated)
 		except RejectedShare as rej:
+			raise self._submitResult(rej)
+		if rv is PendingValidation:
+			self.server.PendingShares += 1
+			raise StratumAsyncReply
+		return self._submitResult(None, share)
+	
+	# Called from other threads; results arriving together are sent together
+	def _queueResult(self, rpcid, share, rej):
+		if self.PendingResults is None:
+			with self._PendingResultsLock:
+				if self.PendingResults is None:
+					self._flushResultsTask = self.flushResults
+					self.PendingResults = collections.deque()
+		self.PendingResults.append((rpcid, share, rej))
+		self.server.scheduleNow(self._flushResultsTask, errHandler=self)
+	
+	def flushResults(self):
+		PR = self.PendingResults
+		self.cork()
+		try:
+			while PR:
+				(rpcid, share, rej) = PR.popleft()
+				self.server.PendingShares -= 1
+				self.sendResult(rpcid, self._submitResult(rej, share))
+		finally:
+			self.uncork()
+	
+	def _submitResult(self, rej, share = None):
+		if rej is None:
+			# checkShare sets the target the share was accepted at
+			self.RecentWork += target2bdiff(share['target'])
+			return True
+		if isinstance(rej, RejectedShare):
 			rej = str(rej)
 			errno = StratumCodes.get(rej, 20)
-			raise StratumError(errno, rej, False)
-		return True
+			return StratumError(errno, rej, False)
+		return rej
 	
 	def _stratum_mining_authorize(self, username, password = None):
 		try:
@@ -229,18 +566,17 @@ class StratumHandler(networkserver.SocketHandler):
 		except:
 			valid = False
 		if valid:
-			self.Usernames[username] = None
+			if username not in self.Usernames:
+				self.Usernames += (username,)
 			self.changeTask(self.requestStratumUA, 0)
 		return valid
 	
 	def _stratum_mining_get_transactions(self, jobid):
 		try:
-			(MC, wld) = self.server.getExistingStratumJob(jobid)
+			return self.server.getTransactions(jobid)
 		except KeyError as e:
 			e.StratumQuiet = True
 			raise
-		(height, merkleTree, cb, prevBlock, bits) = MC[:5]
-		return list(b2a_hex(txn.data).decode('ascii') for txn in merkleTree.data[1:])
 	
 	def _stratum_server_get_source(self, path = ''):
 		s = agplcompliance.get_source(path.encode('utf8'))
@@ -262,16 +598,141 @@ class StratumServer(networkserver.AsyncSocketServer):
 		super().__init__(*a, **ka)
 		
 		self._Clients = {}
+		# {sid: (expiry, JobTargets)} of closed sessions, for resuming them
+		# until their work is stale, in the order they closed
+		self._Sessions = collections.OrderedDict()
+		self.StaleWorkTimeout = 120
+		self._pruneSessionsTask = self._pruneSessions
 		self._JobId = 0
 		self.JobId = '%d' % (time(),)
 		self.WakeRequest = None
 		self.WorkUpdateInterval = 55
 		self.UpdateTask = None
 		self._PendingQuickUpdates = set()
+		
+		# Job updates requested within this long (seconds) of the last new job
+		# are merged into one, sent at the end of the window
+		self.JobCoalesceWindow = 0.1
+		self._UpdateLock = threading.Lock()
+		# None, or whether any merged request wanted a clear job
+		self._UpdateWantClear = None
+		self._UpdateRequests = 0
+		self._LastJobTime = 0
+		self._updateJobTask = self._updateJobNow
+		# Version bits miners may roll with BIP310 (the BIP320 general purpose bits)
+		self.VersionRollingMask = 0x1fffe000
+		
+		# New jobs are sent for at most this long (seconds) per event loop
+		# iteration, so shares keep being read during large broadcasts
+		self.BroadcastTimeSlice = 0.005
+		self._Broadcast = None
+		self._broadcastTask = self._broadcastStep
+		# Time from a new job until every client has been sent it
+		self.BroadcastLatency = DurationHistogram()
+		self.LastBroadcast = None
+		# How often (seconds) to log it, with WriteStats, after a broadcast
+		self.StatsLogInterval = 300
+		self._LastStatsLog = time()
+		
+		# Shares submitted and still being checked by ShareValidator
+		self.PendingShares = 0
+		
+		# When event loop lag (seconds), PendingShares, or the number of clients
+		# goes over any of these limits, ShedFraction of the clients (those
+		# with the least recent work, newest first) are sent client.reconnect to
+		# ShedPeers every ShedInterval seconds, until all of them are back under
+		# ShedResumeLevel of their limits
+		self.ShedPeers = ()
+		self.ShedMaxLoopLag = None
+		self.ShedMaxPendingShares = None
+		self.ShedMaxConnections = None
+		self.ShedFraction = 0.05
+		self.ShedInterval = 10
+		self.ShedResumeLevel = 0.8
+		self.Overloaded = False
+		self.ShedStats = {
+			'overloads': 0,
+			'rounds': 0,
+			'clients': 0,
+		}
+		self._ShedPeer = 0
+		self._NextShed = 0
+		self._LoadCheckTime = None
+		self._checkLoadTask = self._checkLoad
 	
 	def checkAuthentication(self, username, password):
 		return True
 	
+	def final_init(self):
+		if self.ShedPeers:
+			self._LoadCheckTime = time() + 1
+			self.schedule(self._checkLoadTask, self._LoadCheckTime)
+	
+	# Returns the highest fraction of any load limit reached
+	def loadLevel(self, lag):
+		level = 0
+		for (v, limit) in (
+			(lag, self.ShedMaxLoopLag),
+			(self.PendingShares, self.ShedMaxPendingShares),
+			(len(self._Clients), self.ShedMaxConnections),
+		):
+			if limit:
+				level = max(level, v / limit)
+		return level
+	
+	def _checkLoad(self):
+		now = time()
+		# How late this check ran is how far behind the event loop is
+		lag = now - self._LoadCheckTime
+		level = self.loadLevel(lag)
+		if not self.Overloaded:
+			if level > 1:
+				self.Overloaded = True
+				self.ShedStats['overloads'] += 1
+				self.logger.warning('Overloaded (loop lag %.3f seconds, %d pending shares, %d clients); shedding clients' % (lag, self.PendingShares, len(self._Clients)))
+		elif level < self.ShedResumeLevel:
+			self.Overloaded = False
+			self.logger.info('No longer overloaded')
+		if self.Overloaded and now >= self._NextShed:
+			self.shedClients()
+			self._NextShed = now + self.ShedInterval
+		
+		self._LoadCheckTime = now + 1
+		self.schedule(self._checkLoadTask, self._LoadCheckTime)
+	
+	def shedClients(self, fraction = None):
+		if fraction is None:
+			fraction = self.ShedFraction
+		# Newest first, among those with the same recent work
+		C = list(self._Clients.values())
+		C.reverse()
+		C.sort(key=lambda ic: ic.RecentWork)
+		C = C[:max(1, int(len(C) * fraction))]
+		peers = self.ShedPeers
+		for ic in C:
+			(host, port) = peers[self._ShedPeer % len(peers)]
+			self._ShedPeer += 1
+			try:
+				ic.sendReconnect(host, port)
+			except socket.error:
+				pass
+			except:
+				self.logger.debug('Error sending reconnect:\n' + traceback.format_exc())
+		self.ShedStats['rounds'] += 1
+		self.ShedStats['clients'] += len(C)
+		self.logger.info('Sent %d clients to other servers (%d in total)' % (len(C), self.ShedStats['clients']))
+	
+	# Forgets closed sessions once they can no longer be resumed
+	def _pruneSessions(self):
+		Sessions = self._Sessions
+		now = time()
+		while Sessions:
+			(expiry, JobTargets) = next(iter(Sessions.values()))
+			if expiry > now:
+				self.schedule(self._pruneSessionsTask, expiry)
+				break
+			Sessions.popitem(last=False)
+	
 	def updateJobOnly(self, wantClear = False, forceClean = False):
 		self._JobId += 1
 		JobId = '%d %d' % (time(), self._JobId)
@@ -289,22 +750,18 @@ class StratumServer(networkserver.AsyncSocketServer):
 			self.rejecting = False
 			self.logger.info('Coinbase small enough for stratum again: reenabling')
 		
-		txn = deepcopy(merkleTree.data[0])
-		cb += self.extranonce1null + b'Eloi'
-		txn.setCoinbase(cb)
-		txn.assemble()
-		pos = txn.data.index(cb) + len(cb)
+		job = MC[7]
 		
 		steps = list(b2a_hex(h).decode('ascii') for h in merkleTree._steps)
 		
-		self.JobBytes = json.dumps({
+		JobBytes = json.dumps({
 			'id': None,
 			'method': 'mining.notify',
 			'params': [
 				JobId,
 				b2a_hex(swap32(prevBlock)).decode('ascii'),
-				b2a_hex(txn.data[:pos - len(self.extranonce1null) - 4]).decode('ascii'),
-				b2a_hex(txn.data[pos:]).decode('ascii'),
+				b2a_hex(job.coinbasePrefix).decode('ascii'),
+				b2a_hex(job.coinbaseSuffix).decode('ascii'),
 				steps,
 				'%08x' % (merkleTree.MP['version'],),
 				b2a_hex(bits[::-1]).decode('ascii'),
@@ -312,17 +769,58 @@ class StratumServer(networkserver.AsyncSocketServer):
 				forceClean or not self.IsJobValid(self.JobId)
 			],
 		}).encode('ascii') + b"\n"
+		self.JobBytes = JobBytes
 		self.JobId = JobId
+		# Clients are sent one of these, encoded only once per target for each job:
+		#     {target: (bdiff, set_difficulty + notify)}
+		self.JobBlobs = (JobId, JobBytes, {})
 		
+	# May be called from any thread; the new job is made by the event loop
 	def updateJob(self, wantClear = False):
+		with self._UpdateLock:
+			self._UpdateRequests += 1
+			if not self._UpdateWantClear is None:
+				self._UpdateWantClear = self._UpdateWantClear or wantClear
+				return
+			self._UpdateWantClear = wantClear
+			when = max(time(), self._LastJobTime + self.JobCoalesceWindow)
+			self.schedule(self._updateJobTask, when)
+		self.wakeup()
+	
+	# Returns (requests merged, wantClear), or None if no update is pending
+	def _takeUpdateRequest(self):
+		with self._UpdateLock:
+			wantClear = self._UpdateWantClear
+			if wantClear is None:
+				return None
+			requests = self._UpdateRequests
+			self._UpdateWantClear = None
+			self._UpdateRequests = 0
+			try:
+				self.rmSchedule(self._updateJobTask)
+			except KeyError:
+				pass
+		return (requests, wantClear)
+	
+	def _updateJobNow(self):
+		req = self._takeUpdateRequest()
+		if req is None:
+			return
+		(requests, wantClear) = req
+		if requests > 1:
+			self.logger.debug('Merged %d job update requests' % (requests,))
+		
+		self.updateJobOnly(wantClear=wantClear)
+		self._jobUpdated()
+	
+	def _jobUpdated(self):
 		if self.UpdateTask:
 			try:
 				self.rmSchedule(self.UpdateTask)
 			except:
 				pass
 		
-		self.updateJobOnly(wantClear=wantClear)
-		
+		self._LastJobTime = time()
 		self.WakeRequest = 1
 		self.wakeup()
 		
@@ -333,9 +831,13 @@ class StratumServer(networkserver.AsyncSocketServer):
 		self._PendingQuickUpdates = set()
 		QUC = 0
 		for ic in list(self._Clients.values()):
-			if PQU.intersection(ic.Usernames):
+			if ic.TargetKey in PQU:
 				if self.JobId in ic.JobTargets:
+					# This job is clean anyway, so it can stand in for a pending update
+					req = self._takeUpdateRequest()
 					self.updateJobOnly(wantClear=True, forceClean=True)
+					if not req is None:
+						self._jobUpdated()
 				try:
 					ic.sendJob()
 					QUC += 1
@@ -361,22 +863,74 @@ class StratumServer(networkserver.AsyncSocketServer):
 		if not C:
 			self.logger.debug('Nobody to wake up')
 			return
-		OC = len(C)
+		if self._Broadcast:
+			# Clients not reached yet get the new job instead
+			self.logger.debug('Previous job broadcast superseded with %d clients left' % (len(self._Broadcast[0]),))
+		clients = sorted(C.values(), key=lambda ic: ic.RecentWork, reverse=True)
+		for ic in clients:
+			ic.RecentWork /= 2
+		OC = len(clients)
 		self.logger.debug("%d clients to wake up..." % (OC,))
 		
-		now = time()
-		
-		for ic in list(C.values()):
+		# [clients left, start time, clients sent]
+		self._Broadcast = [collections.deque(clients), time(), 0]
+		self._broadcastStep()
+	
+	def _broadcastStep(self):
+		B = self._Broadcast
+		if B is None:
+			return
+		(clients, startT) = B[:2]
+		end = time() + self.BroadcastTimeSlice
+		n = 0
+		while clients:
+			ic = clients.popleft()
+			if ic.fd == -1:
+				continue
 			try:
 				ic.sendJob()
+				B[2] += 1
 			except socket.error:
-				OC -= 1
 				# Ignore socket errors; let the main event loop take care of them later
+				pass
 			except:
-				OC -= 1
 				self.logger.debug('Error sending new job:\n' + traceback.format_exc())
+			n += 1
+			if not n % 0x10 and time() >= end:
+				break
+		if clients:
+			# Let the event loop handle I/O before continuing
+			self.schedule(self._broadcastTask, time())
+			return
 		
-		self.logger.debug('New job sent to %d clients in %.3f seconds' % (OC, time() - now))
+		self._Broadcast = None
+		dt = time() - startT
+		self.BroadcastLatency.add(dt)
+		self.LastBroadcast = (B[2], dt)
+		self.logger.debug('New job sent to %d clients in %.3f seconds' % (B[2], dt))
+		if self.StatsLogInterval and startT + dt >= self._LastStatsLog + self.StatsLogInterval:
+			self.logStats()
+	
+	def logStats(self):
+		self._LastStatsLog = time()
+		h = self.BroadcastLatency
+		self.logger.info('Job broadcasts: %d, taking %.3f seconds mean, %.3f p99, %.3f max; writes: %s' % (h.count, h.mean(), h.percentile(99), h.max, ', '.join('%s %d' % i for i in sorted(self.WriteStats.items()))))
+	
+	# Returns the transactions (but the coinbase) of a job, in hex
+	def getTransactions(self, jobid):
+		(MC, wld) = self.getExistingStratumJob(jobid)
+		(height, merkleTree, cb, prevBlock, bits) = MC[:5]
+		return list(b2a_hex(txn.data).decode('ascii') for txn in merkleTree.data[1:])
 	
 	def getTarget(*a, **ka):
 		return None
+	
+	def resetTarget(*a, **ka):
+		return None
+	
+	# A session's target is no longer needed by a connection (until it resumes)
+	def releaseTarget(*a, **ka):
+		pass
+	
+	def resumeTarget(*a, **ka):
+		pass
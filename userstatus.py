@@ -0,0 +1,198 @@
+# Eloipool - Python Bitcoin pool server
+# Copyright (C) 2011-2013  Luke Dashjr <luke-jr+eloipool@utopios.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+import itertools
+import logging
+import threading
+
+_logger = logging.getLogger('userstatus')
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+	_logger.warning('Error importing \'numpy\' module; dynamic target sweeps will be slower')
+
+# Dynamic targetting state for every username, stored by column
+# Usernames are interned to a uid, which indexes:
+#     targets     exact target (int), or None for the default
+#     targetf     the same as a float (inf for the default), for comparing/sorting
+#     lastUpdate  time of the last retarget
+#     work        shares (in units of the current target) since lastUpdate
+class UserStatus:
+	def __init__(self, capacity = 0x400):
+		self._ids = {}
+		self.names = []
+		self.targets = []
+		self._lock = threading.Lock()
+		if numpy:
+			self.targetf = numpy.empty(capacity)
+			self.lastUpdate = numpy.empty(capacity)
+			self.work = numpy.empty(capacity)
+		else:
+			self.targetf = array('d')
+			self.lastUpdate = array('d')
+			self.work = array('d')
+	
+	def __len__(self):
+		return len(self.names)
+	
+	def __contains__(self, username):
+		return username in self._ids
+	
+	def uid(self, username):
+		return self._ids.get(username)
+	
+	def add(self, username, target, now):
+		with self._lock:
+			uid = self._ids.get(username)
+			if not uid is None:
+				return uid
+			uid = len(self.names)
+			if numpy:
+				if uid >= len(self.work):
+					self._grow(uid * 2)
+				self.targetf[uid] = float(target) if target else numpy.inf
+				self.lastUpdate[uid] = now
+				self.work[uid] = 0
+			else:
+				self.targetf.append(float(target) if target else float('inf'))
+				self.lastUpdate.append(now)
+				self.work.append(0)
+			self.targets.append(target)
+			self.names.append(username)
+			self._ids[username] = uid
+		return uid
+	
+	def _grow(self, capacity):
+		for k in ('targetf', 'lastUpdate', 'work'):
+			a = getattr(self, k)
+			b = numpy.empty(capacity)
+			b[:len(a)] = a
+			setattr(self, k, b)
+	
+	def get(self, uid):
+		return (self.targets[uid], self.lastUpdate[uid], self.work[uid])
+	
+	def set(self, uid, target, now):
+		with self._lock:
+			self._set(uid, target, now)
+	
+	def _set(self, uid, target, now):
+		self.targets[uid] = target
+		self.targetf[uid] = float(target) if target else float('inf')
+		self.lastUpdate[uid] = now
+		self.work[uid] = 0
+	
+	def addWork(self, uid, work):
+		with self._lock:
+			work += self.work[uid]
+			self.work[uid] = work
+		return work
+	
+	# Retargets every row at once, by the same rules as a single retarget; new
+	# targets are passed through clamp. Returns (rows whose target changed,
+	# rows reset to the default target)
+	def sweep(self, now, goal, window, defaultTarget, networkTarget, clamp):
+		networkTarget = float(networkTarget or 0)
+		n = len(self.names)
+		if not numpy:
+			with self._lock:
+				return self._sweepRows(range(n), now, goal, window, defaultTarget, networkTarget, clamp)
+		
+		# Work out the new targets from a snapshot, without holding the lock
+		targetf = self.targetf[:n].copy()
+		lastUpdate = self.lastUpdate[:n].copy()
+		work = self.work[:n].copy()
+		hasTarget = targetf != numpy.inf
+		waiting = (work <= goal) & (now < lastUpdate + window) & (~hasTarget | (targetf >= networkTarget))
+		idle = ~waiting & (work == 0)
+		reset = numpy.flatnonzero(idle & hasTarget)
+		retarget = numpy.flatnonzero(~waiting & ~idle)
+		newTargets = numpy.where(hasTarget[retarget], targetf[retarget], float(defaultTarget))
+		newTargets *= goal * (now - lastUpdate[retarget]) / window / work[retarget]
+		uids = numpy.concatenate((reset, retarget))
+		targets = [None] * len(reset) + [clamp(int(target)) for target in newTargets.tolist()]
+		newTargetf = numpy.array([float(target) if target else numpy.inf for target in targets])
+		
+		with self._lock:
+			# Rows retargetted or given work since the snapshot are worked out again
+			same = (self.targetf[uids] == targetf[uids]) & (self.lastUpdate[uids] == lastUpdate[uids]) & (self.work[uids] == work[uids])
+			(changed, resets) = self._sweepRows(uids[~same].tolist(), now, goal, window, defaultTarget, networkTarget, clamp)
+			uids = uids[same]
+			self.targetf[uids] = newTargetf[same]
+			self.lastUpdate[uids] = now
+			self.work[uids] = 0
+			oldTargets = self.targets
+			for (uid, target) in zip(uids.tolist(), itertools.compress(targets, same.tolist())):
+				if target != oldTargets[uid]:
+					changed += 1
+				oldTargets[uid] = target
+		resets += int(same[:len(reset)].sum())
+		return (changed, resets)
+	
+	# Applies the sweep rules to each of uids, one at a time; the caller must
+	# hold the lock
+	def _sweepRows(self, uids, now, goal, window, defaultTarget, networkTarget, clamp):
+		changed = resets = 0
+		targets = self.targets
+		for uid in uids:
+			targetIn = targets[uid]
+			target = self._sweepRow(targetIn, self.lastUpdate[uid], self.work[uid], now, goal, window, defaultTarget, networkTarget)
+			if target is None:
+				continue
+			if target:
+				target = clamp(int(target))
+			else:
+				target = None
+				resets += 1
+			self._set(uid, target, now)
+			if target != targetIn:
+				changed += 1
+		return (changed, resets)
+	
+	# The sweep rules for one row: returns None to leave it, 0 to reset it to
+	# the default target, or its new (unclamped) target
+	@staticmethod
+	def _sweepRow(targetIn, lastUpdate, work, now, goal, window, defaultTarget, networkTarget):
+		if work <= goal:
+			if now < lastUpdate + window and (targetIn is None or targetIn >= networkTarget):
+				return None
+			if not work:
+				return 0 if targetIn else None
+		return (targetIn or defaultTarget) * goal * (now - lastUpdate) / window / work
+	
+	# Returns [(username, target), ...] for the n highest difficulties, easiest
+	# first, leaving out usernames starting with exclude
+	def top(self, n, exclude = None):
+		count = len(self.names)
+		if n <= 0:
+			return []
+		names = self.names
+		if numpy:
+			targetf = self.targetf[:count]
+			uids = numpy.flatnonzero(targetf != numpy.inf)
+			if exclude:
+				uids = uids[numpy.array([not names[uid].startswith(exclude) for uid in uids.tolist()], dtype=bool)]
+			if len(uids) > n:
+				uids = uids[numpy.argpartition(targetf[uids], n - 1)[:n]]
+			uids = uids[numpy.argsort(-targetf[uids], kind='stable')].tolist()
+		else:
+			targetf = self.targetf
+			uids = sorted((uid for uid in range(count) if targetf[uid] != float('inf') and not (exclude and names[uid].startswith(exclude))), key=lambda uid: targetf[uid])[:n]
+			uids.reverse()
+		return list((names[uid], self.targets[uid]) for uid in uids)
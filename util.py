@@ -153,6 +153,7 @@ class RejectedShare(ValueError):
 	pass
 
 PendingUpstream = object()
+PendingValidation = object()
 
 
 import heapq
@@ -205,6 +206,175 @@ class ScheduleDict:
 	def __len__(self):
 		return len(self._dict)
 
+# Accepted shares, for duplicate detection
+# Partitioned by the work they were issued against, so each partition can be
+# dropped when its work expires from the workLog
+# NOTE: Callers hold lock around add and prune, along with checking or
+#       removing the work itself, so a partition is never added back for
+#       work that was just pruned
+class DupeShareIndex:
+	def __init__(self, digestSize = 12):
+		self._parts = {}
+		self.digestSize = digestSize
+		self.lock = threading.Lock()
+	
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		del state['lock']
+		return state
+	
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.lock = threading.Lock()
+	
+	# Returns True if the share was already seen, otherwise records it
+	def add(self, workKey, blkhash):
+		digest = blkhash[:self.digestSize]
+		try:
+			part = self._parts[workKey]
+		except KeyError:
+			part = self._parts[workKey] = set()
+		if digest in part:
+			return True
+		part.add(digest)
+		return False
+	
+	def prune(self, workKey):
+		self._parts.pop(workKey, None)
+	
+	def clear(self):
+		self._parts = {}
+	
+	def __len__(self):
+		return sum(len(part) for part in tuple(self._parts.values()))
+
+# Durations in power-of-two buckets: bucket i counts those under 2**i microseconds
+class DurationHistogram:
+	def __init__(self, buckets = 24):
+		self.buckets = [0] * buckets
+		self.count = 0
+		self.total = 0.
+		self.max = 0.
+	
+	def add(self, dt):
+		i = min(int(dt * 1e6).bit_length(), len(self.buckets) - 1)
+		self.buckets[i] += 1
+		self.count += 1
+		self.total += dt
+		if dt > self.max:
+			self.max = dt
+	
+	# NOTE: Returns the upper bound of the bucket the percentile falls in
+	def percentile(self, p):
+		n = self.count * p / 100.
+		c = 0
+		for i in range(len(self.buckets)):
+			c += self.buckets[i]
+			if c >= n and c:
+				return min((1 << i) / 1e6, self.max)
+		return self.max
+	
+	def mean(self):
+		return self.total / self.count if self.count else 0.
+	
+	def export(self):
+		return {
+			'count': self.count,
+			'total': self.total,
+			'max': self.max,
+			'buckets': list(self.buckets),
+		}
+
+import itertools
+import threading
+from time import perf_counter
+
+# Counts everything by (protocol, result), and keeps per-stage timings of a
+# sample of them (one every sampleInterval)
+# Stages are recorded as a list of (name, perf_counter()) marks, each timing
+# the work since the previous mark
+class StageTimings:
+	def __init__(self, sampleInterval = 0x40):
+		self.sampleInterval = sampleInterval
+		self._lock = threading.Lock()
+		self.reset()
+	
+	def reset(self):
+		with self._lock:
+			self._n = itertools.count(1)
+			self._local = threading.local()
+			self._counts = []
+			self.stages = {}
+			self.totals = {}
+	
+	# Counts are kept per thread, so unsampled shares never take the lock
+	def _threadCounts(self):
+		local = self._local
+		try:
+			return local.counts
+		except AttributeError:
+			pass
+		counts = local.counts = {}
+		with self._lock:
+			# Left out if reset meanwhile
+			if self._local is local:
+				self._counts.append(counts)
+		return counts
+	
+	@property
+	def counts(self):
+		rv = {}
+		for counts in list(self._counts):
+			for (k, n) in list(counts.items()):
+				rv[k] = rv.get(k, 0) + n
+		return rv
+	
+	# Returns a list to record marks in, or None if this one isn't sampled
+	def sample(self):
+		if not self.sampleInterval or next(self._n) % self.sampleInterval:
+			return None
+		return [(None, perf_counter())]
+	
+	def count(self, protocol, result, marks = None):
+		k = (protocol, result)
+		counts = self._threadCounts()
+		counts[k] = counts.get(k, 0) + 1
+		if not marks:
+			return
+		with self._lock:
+			prevT = marks[0][1]
+			for (stage, t) in marks[1:]:
+				sk = (protocol, stage)
+				if sk not in self.stages:
+					self.stages[sk] = DurationHistogram()
+				self.stages[sk].add(t - prevT)
+				prevT = t
+			if k not in self.totals:
+				self.totals[k] = DurationHistogram()
+			self.totals[k].add(prevT - marks[0][1])
+	
+	def export(self):
+		with self._lock:
+			return {
+				'sampleInterval': self.sampleInterval,
+				'counts': list((p, r, n) for (p, r), n in self.counts.items()),
+				'stages': list((p, s, h.export()) for (p, s), h in self.stages.items()),
+				'totals': list((p, r, h.export()) for (p, r), h in self.totals.items()),
+			}
+	
+	def report(self):
+		o = '%-10s %-20s %10s %10s %10s %10s\n' % ('protocol', 'result/stage', 'count', 'mean us', 'p99 us', 'max us')
+		with self._lock:
+			for (p, r), n in sorted(self.counts.items(), key=lambda i: (str(i[0][0]), str(i[0][1]))):
+				h = self.totals.get((p, r))
+				if h:
+					o += '%-10s %-20s %10d %10.1f %10.1f %10.1f\n' % (p, r, n, h.mean() * 1e6, h.percentile(99) * 1e6, h.max * 1e6)
+				else:
+					o += '%-10s %-20s %10d\n' % (p, r, n)
+			for (p, s), h in sorted(self.stages.items(), key=lambda i: (str(i[0][0]), str(i[0][1]))):
+				o += '%-10s %-20s %10d %10.1f %10.1f %10.1f\n' % (p, '  ' + s, h.count, h.mean() * 1e6, h.percentile(99) * 1e6, h.max * 1e6)
+		return o
+
 class WithNoop:
 	def __enter__(self):
 		pass
@@ -231,6 +401,14 @@ class _UniqueSessionIdManager:
 	def size(self):
 		return self._size
 	
+	# Only issues ids from the index'th of count equal ranges, so processes
+	# sharing one id space (eg, stratum frontends) never issue the same one
+	def partition(self, index, count):
+		span = (self._max + 1) // count
+		with self._NextID_Lock:
+			self._NextID = span * index
+			self._max = self._NextID + span - 1
+	
 	def put(self, sid, delay = False, now = None):
 		if not delay:
 			return self._FreeIDs.append(sid)